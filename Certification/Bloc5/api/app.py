@@ -1,14 +1,22 @@
-import mlflow 
-import uvicorn
-import json
-import pandas as pd 
+# Only light modules are imported here so that the server starts fast:
+# mlflow is imported when a model is loaded from MLflow, pandas when a
+# DataFrame is built, and boto3 only by mlflow for S3 artifacts.
+import asyncio
+import functools
+import io
+import os
+import time
 
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
-from typing import Literal, List, Union
-from fastapi import FastAPI, File, UploadFile
-import boto3
+from typing import Literal, List, Union, Optional
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 
-mlflow.set_tracking_uri("https://getaround-model-server.herokuapp.com/")
+from registry import ModelRegistry, model_uri_for
+from batcher import MicroBatcher
+from cache import PredictionCache, features_key
+from monitoring import Registry, Counter, Gauge, Histogram, Profiler
 
 tag_metadata = [
     {
@@ -17,11 +25,95 @@ tag_metadata = [
     }
 ]
 
+# Pricing model kept in memory for the whole life of the API
+registry = ModelRegistry()
+
+# With PRELOAD_MODEL=1 a local model (MODEL_DIR or a MODEL_URI path) is loaded
+# at import, gunicorn imports the app before forking (gunicorn.conf.py) so
+# every worker shares that copy. A remote model is not waited for at import,
+# nor a local one that fails to load: the lifespan loads it in the background.
+if os.environ.get("PRELOAD_MODEL") == "1" and registry.local:
+    try:
+        registry.load()
+    except Exception:
+        # Kept in last_error, shown by the readiness endpoint
+        pass
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Warm the model in the background unless it was preloaded, /ready stays false until it is loaded
+    loading = None if registry.ready else asyncio.create_task(registry.load_async())
+    await batcher.start()
+    yield
+    await batcher.stop()
+    if loading is not None:
+        loading.cancel()
+
+
 app = FastAPI(
     title="GetAround API helping you to know your price for a rental",
-    openapi_tags=tag_metadata
+    openapi_tags=tag_metadata,
+    lifespan=lifespan
 )
 
+# Repeated quotes are answered without touching the model
+prediction_cache = PredictionCache(
+    max_size=int(os.environ.get("PREDICTION_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("PREDICTION_CACHE_TTL", 3600))
+)
+
+# Request and /Predict stage latencies, exposed on /metrics
+metrics = Registry()
+requests_total = metrics.add(Counter("http_requests_total", "Requests by route and status", ["method", "path", "status"]))
+requests_in_flight = metrics.add(Gauge("http_requests_in_flight", "Requests being processed", ["path"]))
+request_seconds = metrics.add(Histogram("http_request_duration_seconds", "Request latency", ["method", "path"]))
+# Stages of /Predict: parse_validate (body read and pydantic), cache_lookup,
+# batch (wait in the batcher and prediction), serialize (response encoding)
+# and, per batch, frame_build and predict
+stage_seconds = metrics.add(Histogram("predict_stage_duration_seconds", "Latency of each stage of a prediction", ["stage", "model_version"]))
+model_info = metrics.add(Gauge("pricing_model_info", "Model served, 1 for the loaded version", ["model_version", "scoring_mode"]))
+model_load_seconds = metrics.add(Gauge("pricing_model_load_seconds", "Load time of the served model", ["model_version"]))
+batcher_queue_depth = metrics.add(Gauge("batcher_queue_depth", "Predictions waiting for a batch"))
+cache_lookups = metrics.add(Counter("prediction_cache_lookups_total", "Prediction cache lookups since start", ["result"]))
+
+# PROFILING_ENABLED=1 lets a request ask for a profile with the X-Profile header
+profiler = Profiler(enabled=os.environ.get("PROFILING_ENABLED") == "1",
+                    directory=os.environ.get("PROFILE_DIR", "profiles"))
+
+
+@functools.lru_cache(maxsize=None)
+def known_routes():
+    # Every route is declared at import, read once at the first request
+    return frozenset(route.path for route in app.routes)
+
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    # Unknown paths share one label so that scans do not create series
+    path = request.url.path if request.url.path in known_routes() else "other"
+    request.state.received_at = time.perf_counter()
+    requests_in_flight.inc(path=path)
+    status = "500"
+    try:
+        if profiler.requested(request):
+            response, trace = await profiler.run(request, call_next)
+            if trace:
+                response.headers["X-Profile-File"] = trace
+        else:
+            response = await call_next(request)
+        status = str(response.status_code)
+    finally:
+        requests_in_flight.dec(path=path)
+        requests_total.inc(method=request.method, path=path, status=status)
+        request_seconds.observe(time.perf_counter() - request.state.received_at, method=request.method, path=path)
+
+    # The response is encoded between the end of the endpoint and here
+    if hasattr(request.state, "handler_done"):
+        stage_seconds.observe(time.perf_counter() - request.state.handler_done,
+                              stage="serialize", model_version=request.state.model_version)
+    return response
+
 
 @app.get("/")
 async def index():
@@ -46,26 +138,188 @@ class PredictionFeatures(BaseModel):
     winter_tires: bool = True
 
 
+# Columns expected by the model, in the order used at training time
+features_list = list(PredictionFeatures.__fields__)
+
+
+def features_frame(items):
+    """
+    Build one columnar DataFrame from a list of PredictionFeatures
+    """
+    import pandas as pd
+    return pd.DataFrame({name: [getattr(item, name) for item in items] for name in features_list})
+
+
+def model_input(items):
+    # The fast scorer reads plain dicts, the pyfunc model needs a DataFrame
+    if registry.scoring_mode == 'fast':
+        return [dict(item) for item in items]
+    return features_frame(items)
+
+
+def check_ready():
+    if not registry.ready:
+        raise HTTPException(status_code=503, detail="The model is still loading, check /ready")
+
+
+async def predict_frame(data):
+    # Vectorized prediction in a worker thread so the event loop is not blocked
+    loop = asyncio.get_running_loop()
+    prediction = await loop.run_in_executor(None, registry.predict, data)
+    return prediction.tolist()
+
+
+def predict_many(items):
+    version = registry.version
+    with stage_seconds.time(stage="frame_build", model_version=version):
+        data = model_input(items)
+    with stage_seconds.time(stage="predict", model_version=version):
+        return registry.predict(data).tolist()
+
+
+# Concurrent /Predict calls are grouped into one vectorized prediction
+batcher = MicroBatcher(
+    predict_many,
+    max_wait_ms=float(os.environ.get("BATCH_MAX_WAIT_MS", 5)),
+    max_batch_size=int(os.environ.get("BATCH_MAX_SIZE", 64))
+)
+
+
+class ModelSwap(BaseModel):
+    run_id: Optional[str] = None
+    version: Optional[str] = None
+
+
+@app.get("/ready")
+async def ready():
+    """
+    Tell if the pricing model is loaded and ready to make predictions,
+    with a 503 status while it loads or after a failed load so that readiness probes wait
+    """
+    return JSONResponse(registry.status(), status_code=200 if registry.ready else 503)
+
+
+@app.post("/Model/swap", tags=['Model'], status_code=202)
+async def swap_model(modelSwap: ModelSwap, background_tasks: BackgroundTasks):
+    """
+    Load another run or registered version of the model in the background and serve it once loaded
+    """
+    try:
+        model_uri = model_uri_for(modelSwap.run_id, modelSwap.version)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    background_tasks.add_task(registry.load_async, model_uri)
+    return {"loading": model_uri, "serving": registry.version}
+
+
 @app.post("/Predict" , tags=['Predictor'])
-async def predict(predictionFeatures: PredictionFeatures):
+async def predict(predictionFeatures: PredictionFeatures, request: Request):
     """
     Make a rental price prediction with the rental and car informations
     """
 
-    price_rental_per_day = pd.DataFrame(dict(predictionFeatures), index=[0])
+    check_ready()
 
-    # Log model from mlflow 
-    logged_model = 'runs:/4342329ee93b4a7b8b4fb93c7662e555/pricing_cars_predictor'
-
-    # Load model as a PyFuncModel.
-    loaded_model = mlflow.pyfunc.load_model(logged_model)
-    prediction = loaded_model.predict(price_rental_per_day)
+    # Model version read once so a swap during the call cannot mix versions,
+    # the cache is keyed on the load so a reload of the same uri drops it too
+    version = registry.version
+    load_token = registry.load_token
+    stage_seconds.observe(time.perf_counter() - request.state.received_at, stage="parse_validate", model_version=version)
+    with stage_seconds.time(stage="cache_lookup", model_version=version):
+        key = features_key(dict(predictionFeatures))
+        prediction = prediction_cache.get(key, load_token)
+    cache_lookups.inc(result="miss" if prediction is None else "hit")
+    if prediction is None:
+        # Predicted together with the other requests received at the same time
+        with stage_seconds.time(stage="batch", model_version=version):
+            prediction = await batcher.submit(predictionFeatures)
+        # Not cached if the model was swapped or reloaded while predicting
+        if registry.load_token == load_token:
+            prediction_cache.put(key, load_token, prediction)
 
     # Format response
-    response = {"prediction": prediction.tolist()[0]}
+    response = {"prediction": prediction}
+    request.state.handler_done = time.perf_counter()
+    request.state.model_version = version
     return response
 
 
+@app.get("/batcher/stats", tags=['Monitoring'])
+async def batcher_stats():
+    """
+    Queue depth and batch size histogram of the micro-batching scheduler
+    """
+    return batcher.stats()
+
+
+@app.get("/cache/stats", tags=['Monitoring'])
+async def cache_stats():
+    """
+    Hits, misses and evictions of the prediction cache
+    """
+    return prediction_cache.stats()
+
+
+@app.get("/metrics", tags=['Monitoring'], response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """
+    Request counts, latency histograms per route and per prediction stage, in the Prometheus text format
+    """
+    if registry.ready:
+        model_info.clear()
+        model_info.set(1, model_version=registry.version, scoring_mode=registry.scoring_mode)
+        model_load_seconds.set(registry.load_time, model_version=registry.version)
+    batcher_queue_depth.set(batcher.stats()["queue_depth"])
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/predict/batch", tags=['Predictor'])
+async def predict_batch(predictionFeatures: List[PredictionFeatures]):
+    """
+    Make rental price predictions for a list of rentals, predictions are returned in the input order
+    """
+    check_ready()
+    if not predictionFeatures:
+        raise HTTPException(status_code=422, detail="The list of rentals is empty")
+
+    prediction = await predict_frame(model_input(predictionFeatures))
+    return {"prediction": prediction}
+
+
+@app.post("/predict/batch/file", tags=['Predictor'])
+async def predict_batch_file(file: UploadFile = File(...)):
+    """
+    Make rental price predictions for every row of a CSV or Parquet file having the rental and car informations
+    """
+    check_ready()
+
+    import pandas as pd
+    # model-MLFlow/schema.py, copied in the image at build time (PYTHONPATH=../model-MLFlow when run locally)
+    import schema
+
+    content = io.BytesIO(await file.read())
+    # Both formats go through the schema: missing columns are reported, the training dtypes are
+    # applied and unknown categories become missing values, ignored by the model
+    parquet = file.filename.lower().endswith(".parquet")
+    if parquet:
+        try:
+            raw = pd.read_parquet(content)
+        except Exception as e:
+            raise HTTPException(status_code=422, detail=f"Unreadable Parquet file: {e}")
+    try:
+        if parquet:
+            data = schema.conform(raw, target=False, strict=False, source="the file")
+        else:
+            data = schema.read_csv(content, target=False, strict=False)
+        data = schema.plain_frame(data)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    prediction = await predict_frame(data)
+    return {"prediction": prediction}
+
 
 if __name__=="__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=4010)
\ No newline at end of file
@@ -0,0 +1,26 @@
+# Download the served model into a local directory, at image build time
+#
+# The API started with MODEL_DIR=<dir> loads it from disk: no call to the
+# tracking server, and no mlflow import at all with SCORING_MODE=fast (the
+# compiled scorer logged by train.py is part of the model artifacts).
+#
+# Usage: python bake_model.py [model_uri] [model_dir]
+
+import os
+import shutil
+import sys
+import tempfile
+
+from registry import DEFAULT_MODEL_URI, SCORER_ARTIFACT, mlflow_module
+
+if __name__ == "__main__":
+    model_uri = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('MODEL_URI', DEFAULT_MODEL_URI)
+    model_dir = sys.argv[2] if len(sys.argv) > 2 else os.environ.get('MODEL_DIR', 'model')
+
+    # Artifacts are downloaded under their own name, the model files are then copied to model_dir
+    with tempfile.TemporaryDirectory() as directory:
+        downloaded = mlflow_module().artifacts.download_artifacts(artifact_uri=model_uri, dst_path=directory)
+        shutil.copytree(downloaded, model_dir, dirs_exist_ok=True)
+    if not os.path.exists(os.path.join(model_dir, SCORER_ARTIFACT)):
+        print(f"No {SCORER_ARTIFACT} in {model_uri}, only SCORING_MODE=pyfunc can serve it")
+    print(f"{model_uri} baked in {model_dir}")
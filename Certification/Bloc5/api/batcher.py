@@ -0,0 +1,100 @@
+import asyncio
+import bisect
+import time
+
+
+class MicroBatcher:
+    """
+    Group concurrent single predictions into one vectorized call.
+
+    Requests wait in a queue until max_batch_size rows are collected or the
+    first one has waited max_wait_ms, then the whole batch goes through
+    predict_many and every caller gets its own result back.
+    """
+
+    def __init__(self, predict_many, max_wait_ms=5, max_batch_size=64):
+        self.predict_many = predict_many
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.queue = None
+        self.worker = None
+
+        # Batch size histogram buckets: 1, 2, 4, ... up to max_batch_size
+        self.buckets = [1]
+        while self.buckets[-1] < max_batch_size:
+            self.buckets.append(min(self.buckets[-1] * 2, max_batch_size))
+        self.histogram = [0] * len(self.buckets)
+        self.batches = 0
+        self.requests = 0
+        self.max_queue_depth = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    async def submit(self, item):
+        """
+        Queue one item and wait for its prediction
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+    async def _collect(self):
+        # Block for the first item, then fill the batch until the deadline
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            items = [item for item, _ in batch]
+            self._record(len(batch))
+            try:
+                results = await loop.run_in_executor(None, self.predict_many, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                # The caller may have gone away (client disconnected)
+                if not future.done():
+                    future.set_result(result)
+
+    def _record(self, size):
+        self.batches += 1
+        self.requests += size
+        self.histogram[bisect.bisect_left(self.buckets, size)] += 1
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "max_queue_depth": self.max_queue_depth,
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0,
+            "batch_size_histogram": {f"<={bucket}": count for bucket, count in zip(self.buckets, self.histogram)},
+            "max_wait_ms": self.max_wait * 1000,
+            "max_batch_size": self.max_batch_size,
+        }
@@ -0,0 +1,62 @@
+# Parity check and benchmark of the fast scorer against the sklearn pipeline
+#
+# Usage: python bench_scorer.py <model_uri> <fast_scorer.json> [pricing.csv]
+
+import sys
+import time
+
+import mlflow
+import numpy as np
+import pandas as pd
+
+from fast_scorer import FastScorer
+
+features_list = ['model_key', 'mileage', 'engine_power', 'fuel',
+       'paint_color', 'car_type', 'private_parking_available', 'has_gps',
+       'has_air_conditioning', 'automatic_car', 'has_getaround_connect',
+       'has_speed_regulator', 'winter_tires']
+
+
+def per_row(predict, rows, repeat):
+    # Mean latency of one single-row prediction, in microseconds
+    start_time = time.perf_counter()
+    for i in range(repeat):
+        predict(rows[i % len(rows)])
+    return (time.perf_counter() - start_time) / repeat * 1e6
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        sys.exit("Usage: python bench_scorer.py <model_uri> <fast_scorer.json> [pricing.csv]")
+
+    csv_path = sys.argv[3] if len(sys.argv) > 3 else "../model-MLFlow/get_around_pricing_project.csv"
+    data = pd.read_csv(csv_path).loc[:, features_list]
+    rows = data.to_dict(orient="records")
+
+    pipeline = mlflow.sklearn.load_model(sys.argv[1])
+    scorer = FastScorer.from_file(sys.argv[2])
+
+    # Parity on the whole dataset, row by row and vectorized
+    expected = pipeline.predict(data)
+    np.testing.assert_allclose(scorer.predict(rows), expected, rtol=1e-9, atol=1e-6)
+    np.testing.assert_allclose([scorer.predict_one(row) for row in rows], expected, rtol=1e-9, atol=1e-6)
+    print(f"Parity OK on {len(rows)} rows")
+
+    repeat = 500
+    frames = [pd.DataFrame(row, index=[0]) for row in rows[:repeat]]
+    sklearn_us = per_row(pipeline.predict, frames, repeat)
+    # Same path as the API: DataFrame built from the request on every call
+    sklearn_build_us = per_row(lambda row: pipeline.predict(pd.DataFrame(row, index=[0])), rows, repeat)
+    fast_us = per_row(scorer.predict_one, rows, repeat)
+    print(f"Single row, sklearn pipeline:            {sklearn_us:10.1f} us")
+    print(f"Single row, DataFrame build + pipeline:  {sklearn_build_us:10.1f} us")
+    print(f"Single row, fast scorer:                 {fast_us:10.1f} us  (x{sklearn_build_us / fast_us:.0f})")
+
+    start_time = time.perf_counter()
+    pipeline.predict(data)
+    sklearn_batch = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    scorer.predict(rows)
+    fast_batch = time.perf_counter() - start_time
+    print(f"Batch of {len(rows)}, sklearn pipeline: {sklearn_batch * 1000:8.2f} ms")
+    print(f"Batch of {len(rows)}, fast scorer:      {fast_batch * 1000:8.2f} ms")
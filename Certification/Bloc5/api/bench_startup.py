@@ -0,0 +1,57 @@
+# Cold start benchmark of the API
+#
+# Each scoring mode is started in a fresh interpreter, as a new container
+# would, and times the import of the app, the model load and the first
+# prediction, then lists which heavy modules ended up imported.
+#
+# Usage: python bench_startup.py <model_dir> [runs]
+#   model_dir is a baked model (bake_model.py) holding fast_scorer.json
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ['mlflow', 'pandas', 'sklearn', 'boto3', 'numpy']
+
+STARTUP = """
+import json, sys, time
+start_time = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.registry.load()
+loaded = time.perf_counter()
+app.predict_many([app.PredictionFeatures()])
+predicted = time.perf_counter()
+print(json.dumps({
+    'import_s': imported - start_time,
+    'load_s': loaded - imported,
+    'first_prediction_s': predicted - loaded,
+    'modules': [name for name in %r if name in sys.modules],
+}))
+""" % HEAVY_MODULES
+
+
+def start(scoring_mode, model_dir):
+    env = dict(os.environ, SCORING_MODE=scoring_mode, MODEL_DIR=model_dir)
+    env.pop('MODEL_URI', None)
+    env.pop('PRELOAD_MODEL', None)
+    output = subprocess.run([sys.executable, '-c', STARTUP], env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python bench_startup.py <model_dir> [runs]")
+    model_dir = os.path.abspath(sys.argv[1])
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    for scoring_mode in ['pyfunc', 'fast']:
+        results = [start(scoring_mode, model_dir) for _ in range(runs)]
+        timings = {key: statistics.median(result[key] for result in results)
+                   for key in ['import_s', 'load_s', 'first_prediction_s']}
+        total = sum(timings.values())
+        print(f"{scoring_mode:7} import {timings['import_s']:6.2f} s  load {timings['load_s']:6.2f} s  "
+              f"first prediction {timings['first_prediction_s']:6.3f} s  total {total:6.2f} s  "
+              f"modules {', '.join(results[0]['modules'])}")
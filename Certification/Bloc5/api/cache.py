@@ -0,0 +1,81 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+
+def features_key(features):
+    """
+    Canonical hash of validated features, same values give the same key
+    """
+    payload = json.dumps(features, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache of predictions with a time to live.
+
+    Entries belong to one model version, a token of the model load: as soon as
+    a lookup is made with another version (the model was swapped or reloaded)
+    the whole cache is dropped.
+    """
+
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.version = version
+
+    def get(self, key, version):
+        self._check_version(version)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, version, value):
+        if self.max_size <= 0:
+            return
+        self._check_version(version)
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "model_version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
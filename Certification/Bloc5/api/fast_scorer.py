@@ -0,0 +1,57 @@
+import json
+
+import numpy as np
+
+
+class FastScorer:
+    """
+    Score rentals from the compiled pricing artifact (model-MLFlow/export_scorer.py).
+
+    A price is the intercept, plus the weight of each category found in the
+    lookup tables (unknown categories weigh nothing, like handle_unknown='ignore'),
+    plus the standardized numerical features times their coefficient.
+    """
+
+    def __init__(self, artifact):
+        self.features = artifact["features"]
+        self.intercept = artifact["intercept"]
+        self.categorical = artifact["categorical"]
+        # Fold the scaler into the coefficient: coef * (x - mean) / scale = weight * x - offset
+        self.numerical = {
+            name: (stats["coef"] / stats["scale"], stats["coef"] * stats["mean"] / stats["scale"])
+            for name, stats in artifact["numerical"].items()
+        }
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def predict_one(self, features):
+        """
+        Price of one rental given as a mapping of feature name to value
+        """
+        price = self.intercept
+        for name, table in self.categorical.items():
+            price += table.get(str(features[name]), 0.0)
+        for name, (weight, offset) in self.numerical.items():
+            price += weight * features[name] - offset
+        return price
+
+    def predict(self, data):
+        """
+        Prices of many rentals, data is a list of mappings or a DataFrame
+        """
+        if isinstance(data, list):
+            columns = {name: [row[name] for row in data] for name in self.features}
+            size = len(data)
+        else:
+            columns = data
+            size = len(data)
+
+        price = np.full(size, self.intercept)
+        for name, table in self.categorical.items():
+            price += np.fromiter((table.get(str(value), 0.0) for value in columns[name]), dtype=float, count=size)
+        for name, (weight, offset) in self.numerical.items():
+            price += weight * np.asarray(columns[name], dtype=float) - offset
+        return price
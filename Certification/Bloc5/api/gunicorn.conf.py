@@ -0,0 +1,23 @@
+# gunicorn settings of the API: python -m gunicorn app:app -c gunicorn.conf.py
+#
+# The app, and the model with it, is imported once in the master process
+# before the workers are forked. Workers share the model memory copy-on-write
+# instead of loading one copy each. Only a model on disk is preloaded, a
+# remote one is loaded by each worker in the background (see app.py) so the
+# master never blocks on the tracking server.
+
+import gc
+import os
+
+os.environ.setdefault("PRELOAD_MODEL", "1")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 4000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+
+def when_ready(server):
+    # Objects loaded so far are left alone by the garbage collector, so that
+    # its bookkeeping does not copy their pages in every worker
+    gc.freeze()
@@ -0,0 +1,201 @@
+import cProfile
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from 0.5 ms to 10 s
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric:
+    """
+    A named family of series, one per combination of label values.
+
+    Updates can come from the event loop and from executor threads, they are
+    made under a lock.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def clear(self):
+        with self._lock:
+            self.series.clear()
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            series = list(self.series.items())
+        return self.header() + [f'{self.name}{format_labels(self.labels, key)} {value}' for key, value in series]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.series[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = list(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self.series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            # Cumulative buckets, the last one is +Inf
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.series[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def render(self):
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self.series.items()]
+        lines = self.header()
+        for key, counts, total in series:
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                labels = format_labels(self.labels + ('le',), key + (bound,))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = format_labels(self.labels, key)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {counts[-1]}')
+        return lines
+
+
+class Registry:
+    """
+    Metrics of the API, rendered in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class Profiler:
+    """
+    Profile single requests on demand.
+
+    When enabled, a request with X-Profile: 1 (or true, or ?profile=1) is run
+    under pyinstrument when it is installed (HTML report, follows awaits) or
+    cProfile otherwise (.prof file, readable with pstats or snakeviz). cProfile
+    sees everything the event loop runs during the request, other requests
+    included, but not the executor threads.
+
+    Only one request is profiled at a time, both profilers refuse to start
+    while another one runs: a request asking for a profile meanwhile is run
+    without one and gets no trace file.
+    """
+
+    def __init__(self, enabled=False, directory='profiles'):
+        self.enabled = enabled
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def requested(self, request):
+        # Only an explicit "1" or "true" asks for a profile, "0" or "false" do not
+        value = request.headers.get('x-profile') or request.query_params.get('profile') or ''
+        return self.enabled and value.strip().lower() in ('1', 'true')
+
+    def _path(self, request, extension):
+        os.makedirs(self.directory, exist_ok=True)
+        name = re.sub(r'[^A-Za-z0-9]+', '_', request.url.path).strip('_') or 'root'
+        return os.path.join(self.directory, f'{name}-{time.strftime("%Y%m%d_%H%M%S")}-{time.perf_counter_ns()}.{extension}')
+
+    async def run(self, request, call_next):
+        """
+        Run the request under the profiler, returns the response and the trace file (None if busy)
+        """
+        if not self._lock.acquire(blocking=False):
+            return await call_next(request), None
+        try:
+            return await self._run(request, call_next)
+        finally:
+            self._lock.release()
+
+    async def _run(self, request, call_next):
+        try:
+            from pyinstrument import Profiler as Instrument
+        except ImportError:
+            Instrument = None
+
+        if Instrument is not None:
+            profiler = Instrument(async_mode='enabled')
+            profiler.start()
+            try:
+                response = await call_next(request)
+            finally:
+                profiler.stop()
+            path = self._path(request, 'html')
+            with open(path, 'w') as f:
+                f.write(profiler.output_html())
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                response = await call_next(request)
+            finally:
+                profiler.disable()
+            path = self._path(request, 'prof')
+            profiler.dump_stats(path)
+        return response, path
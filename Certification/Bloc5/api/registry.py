@@ -0,0 +1,148 @@
+import asyncio
+import os
+import threading
+import time
+
+from fast_scorer import FastScorer
+
+# Model served when nothing else is configured
+DEFAULT_MODEL_URI = 'runs:/4342329ee93b4a7b8b4fb93c7662e555/pricing_cars_predictor'
+# Name used by train.py when registering the model
+REGISTERED_MODEL_NAME = 'pricing_cars_linearReg'
+# Compiled scorer logged next to the model by train.py
+SCORER_ARTIFACT = 'fast_scorer.json'
+# Tracking server of the runs:/ and models:/ uris
+DEFAULT_TRACKING_URI = 'https://getaround-model-server.herokuapp.com/'
+
+
+def model_uri_for(run_id=None, version=None):
+    """
+    Build an MLflow model uri from a run id or a registered model version
+    """
+    if run_id:
+        return f'runs:/{run_id}/pricing_cars_predictor'
+    if version:
+        return f'models:/{REGISTERED_MODEL_NAME}/{version}'
+    raise ValueError("A run_id or a version is needed to build a model uri")
+
+
+def mlflow_module():
+    # Imported on the first load from MLflow, it is the slowest import of the API
+    import mlflow
+    mlflow.set_tracking_uri(os.environ.get('MLFLOW_TRACKING_URI', DEFAULT_TRACKING_URI))
+    return mlflow
+
+
+class ModelRegistry:
+    """
+    Keep the pricing model in memory so that predictions never load it.
+
+    The model is loaded once when the API starts and can be replaced in the
+    background: the new model is fully loaded before the reference is swapped,
+    so requests already running keep using the previous one.
+
+    With scoring_mode 'fast' the compiled scorer is served instead of the
+    pyfunc model, it predicts from plain dicts without pandas nor sklearn.
+    """
+
+    def __init__(self, model_uri=None, scoring_mode=None):
+        # MODEL_DIR is a model baked in the image (bake_model.py), loaded without the tracking server
+        model_dir = os.environ.get('MODEL_DIR')
+        if model_dir and not os.path.isdir(model_dir):
+            model_dir = None
+        self.model_uri = model_uri or os.environ.get('MODEL_URI') or model_dir or DEFAULT_MODEL_URI
+        self.scoring_mode = scoring_mode or os.environ.get('SCORING_MODE', 'pyfunc')
+        self.model = None
+        self.loaded_at = None
+        self.load_time = None
+        self.loading_uri = None
+        self.last_error = None
+        # Incremented by every load, reloading the same uri gives another model
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.model is not None
+
+    @property
+    def version(self):
+        # The uri identifies the loaded model (run or registered version)
+        return self.model_uri if self.ready else None
+
+    @property
+    def local(self):
+        # A model directory or compiled scorer on disk, loaded without the tracking server
+        return os.path.exists(self.model_uri)
+
+    @property
+    def load_token(self):
+        # Identifies one load of the model, cached predictions belong to it
+        with self._lock:
+            return f'{self.model_uri}#{self.generation}' if self.model is not None else None
+
+    def load(self, model_uri=None):
+        """
+        Load a model and make it the served one (blocking)
+        """
+        model_uri = model_uri or self.model_uri
+        self.loading_uri = model_uri
+        try:
+            start_time = time.time()
+            if self.scoring_mode == 'fast':
+                model = self._load_fast_scorer(model_uri)
+            else:
+                model = mlflow_module().pyfunc.load_model(model_uri)
+            load_time = time.time() - start_time
+        except Exception as e:
+            self.last_error = f'{model_uri}: {e}'
+            raise
+        finally:
+            self.loading_uri = None
+
+        with self._lock:
+            self.model = model
+            self.model_uri = model_uri
+            self.loaded_at = time.time()
+            self.load_time = load_time
+            self.last_error = None
+            self.generation += 1
+        return model
+
+    def _load_fast_scorer(self, model_uri):
+        # A local compiled artifact or model directory is read without importing mlflow
+        if model_uri.endswith('.json'):
+            return FastScorer.from_file(model_uri)
+        if os.path.isdir(model_uri):
+            return FastScorer.from_file(os.path.join(model_uri, SCORER_ARTIFACT))
+        model_dir = mlflow_module().artifacts.download_artifacts(artifact_uri=model_uri)
+        return FastScorer.from_file(os.path.join(model_dir, SCORER_ARTIFACT))
+
+    async def load_async(self, model_uri=None):
+        """
+        Load a model in a worker thread so the event loop keeps serving requests
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.load, model_uri)
+        except Exception:
+            # The error is kept in last_error and shown by the readiness endpoint
+            pass
+
+    def predict(self, data):
+        # Keep a local reference, a swap during the call does not affect it
+        model = self.model
+        if model is None:
+            raise RuntimeError("The model is not loaded yet")
+        return model.predict(data)
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "scoring_mode": self.scoring_mode,
+            "model_uri": self.version,
+            "load_time": self.load_time,
+            "loaded_at": self.loaded_at,
+            "loading": self.loading_uri,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,220 @@
+# Training and inference benchmark of the pricing model
+#
+# Times every stage of the model life on the sample dataset and on synthetic
+# datasets 10x, 100x and 1000x bigger (rows of the sample drawn with
+# replacement, numerical columns jittered):
+#   csv_load              pd.read_csv of the dataset
+#   csv_load_typed        read with the schema dtypes shared with the API
+#   preprocess_fit        fit of the encoder and scaler
+#   preprocess_transform  transform of the whole dataset
+#   model_fit             fit of the full pipeline, as train.py does
+#   pyfunc_batch          one pyfunc predict on the whole dataset
+# and, once, the serving path of a model trained on the sample:
+#   pyfunc_single_row     pyfunc predict of a one row DataFrame
+#   api_predict           POST /Predict through an in-process FastAPI test client
+#
+# Results are written as JSON. With --baseline, a previous result file is
+# compared stage by stage and slower stages are reported.
+#
+# Usage: python benchmark.py [--scales 1,10,100,1000] [--output results.json] [--baseline previous.json]
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import mlflow
+import numpy as np
+import pandas as pd
+import sklearn
+
+from search import build_preprocessor, build_pipeline
+
+DATASET = "get_around_pricing_project.csv"
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+
+import schema
+from schema import features_list, categorical_features, numerical_features, target_variable
+
+# Same model as train.py without search
+DEFAULT_TRIAL = {'regressor': 'LinearRegression', 'drop': 'first'}
+
+
+def synthetic_dataset(sample, scale, seed=0):
+    """
+    Sample rows drawn with replacement, mileage, engine power and price jittered by about 5%
+    """
+    if scale == 1:
+        return sample
+    rng = np.random.default_rng(seed)
+    data = sample.iloc[rng.integers(0, len(sample), len(sample) * scale)].reset_index(drop=True)
+    for column in ['mileage', 'engine_power', target_variable]:
+        jitter = rng.normal(1, 0.05, len(data))
+        data[column] = np.maximum(data[column] * jitter, 0).round().astype(sample[column].dtype)
+    return data
+
+
+def timed(function, repeat):
+    # Best and median wall time of repeated calls, the result of the last one
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start_time)
+    return {'best_s': min(times), 'median_s': statistics.median(times)}, result
+
+
+def latencies(function, calls):
+    # Latency distribution of calls made one after the other, in milliseconds
+    times = []
+    for call in calls:
+        start_time = time.perf_counter()
+        function(call)
+        times.append((time.perf_counter() - start_time) * 1000)
+    times = np.array(times)
+    return {
+        'calls': len(times),
+        'mean_ms': float(times.mean()),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'p99_ms': float(np.percentile(times, 99)),
+    }
+
+
+def bench_scale(sample, scale, repeat, directory):
+    data = synthetic_dataset(sample, scale)
+    rows = len(data)
+    path = os.path.join(directory, f"pricing_x{scale}.csv")
+    data.to_csv(path)
+    results = []
+
+    def record(stage, timing):
+        results.append({'stage': stage, 'scale': scale, 'rows': rows, **timing})
+        print(f"x{scale:<5} {stage:22} {timing['best_s']:9.3f} s")
+
+    timing, data = timed(lambda: pd.read_csv(path, index_col=0), repeat)
+    record('csv_load', timing)
+    X, Y = data.loc[:, features_list], data.loc[:, target_variable]
+    timing, _ = timed(lambda: schema.read_csv(path), repeat)
+    record('csv_load_typed', timing)
+
+    preprocessor = build_preprocessor(DEFAULT_TRIAL, categorical_features, numerical_features)
+    timing, _ = timed(lambda: preprocessor.fit(X), repeat)
+    record('preprocess_fit', timing)
+    timing, _ = timed(lambda: preprocessor.transform(X), repeat)
+    record('preprocess_transform', timing)
+
+    model = build_pipeline(DEFAULT_TRIAL, categorical_features, numerical_features)
+    timing, _ = timed(lambda: model.fit(X, Y), repeat)
+    record('model_fit', timing)
+
+    model_path = os.path.join(directory, f"model_x{scale}")
+    mlflow.sklearn.save_model(model, model_path)
+    pyfunc = mlflow.pyfunc.load_model(model_path)
+    timing, _ = timed(lambda: pyfunc.predict(X), repeat)
+    record('pyfunc_batch', timing)
+    return results, model_path
+
+
+def bench_serving(sample, model_path, calls):
+    rows = sample.loc[:, features_list].head(calls)
+    records = rows.to_dict(orient="records")
+    results = []
+
+    pyfunc = mlflow.pyfunc.load_model(model_path)
+    frames = [rows.iloc[[i]] for i in range(len(rows))]
+    timing = latencies(pyfunc.predict, frames)
+    results.append({'stage': 'pyfunc_single_row', **timing})
+    print(f"pyfunc_single_row     p50 {timing['p50_ms']:8.3f} ms  p95 {timing['p95_ms']:8.3f} ms")
+
+    # The API serves the model just trained, every request reaches the model
+    os.environ["MODEL_URI"] = model_path
+    os.environ["PREDICTION_CACHE_SIZE"] = "0"
+    from fastapi.testclient import TestClient
+    # The API is benchmarked in place, it imports our schema module
+    sys.path.append(API_DIR)
+    from app import app, registry
+
+    with TestClient(app) as client:
+        while not registry.ready:
+            if registry.last_error:
+                raise RuntimeError(registry.last_error)
+            time.sleep(0.05)
+        timing = latencies(lambda record: client.post("/Predict", json=record).raise_for_status(), records)
+    results.append({'stage': 'api_predict', **timing})
+    print(f"api_predict           p50 {timing['p50_ms']:8.3f} ms  p95 {timing['p95_ms']:8.3f} ms")
+    return results
+
+
+def environment():
+    return {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'sklearn': sklearn.__version__,
+        'mlflow': mlflow.__version__,
+    }
+
+
+def stage_key(result):
+    return (result['stage'], result.get('scale'))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Stages slower than the baseline by more than the tolerance, as (stage, scale, ratio)
+    """
+    previous = {stage_key(result): result for result in baseline['results']}
+    slower = []
+    for result in results:
+        before = previous.get(stage_key(result))
+        if before is None:
+            continue
+        metric = 'best_s' if 'best_s' in result else 'p50_ms'
+        ratio = result[metric] / before[metric]
+        print(f"{result['stage']:22} x{result.get('scale', 1):<5} {ratio:6.2f} of baseline")
+        if ratio > 1 + tolerance:
+            slower.append((result['stage'], result.get('scale'), ratio))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark training and inference of the pricing model")
+    parser.add_argument("--data", default=DATASET)
+    parser.add_argument("--scales", default="1,10,100,1000", help="sizes of the datasets, multiples of the sample")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each training stage, the best one is kept")
+    parser.add_argument("--calls", type=int, default=500, help="requests of the single row and API stages")
+    parser.add_argument("--output", default=f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    parser.add_argument("--baseline", help="previous result file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown reported as a regression")
+    args = parser.parse_args()
+
+    sample = pd.read_csv(args.data, index_col=0)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        serving_model = None
+        for scale in [int(scale) for scale in args.scales.split(',')]:
+            scale_results, model_path = bench_scale(sample, scale, args.repeat, directory)
+            results.extend(scale_results)
+            if scale == 1 or serving_model is None:
+                serving_model = model_path
+        results.extend(bench_serving(sample, serving_model, args.calls))
+
+    report = {'environment': environment(), 'scales': args.scales, 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved in {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for stage, scale, ratio in slower:
+            print(f"Regression: {stage} x{scale} is {ratio:.2f} times slower")
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,79 @@
+# Parity check of the compiled scorer against the sklearn pipeline, offline
+#
+# Pipelines are fitted locally on the bundled CSV with every encoder drop
+# option used by train.py and the search ('first' and None, so with and
+# without drop_idx_), compiled with export_scorer.py and scored by the API
+# FastScorer. Rows with categories never seen at fit time are scored too: the
+# pipeline ignores them (handle_unknown='ignore') and the scorer gives them no
+# weight. No tracking server nor model uri is needed.
+#
+# Usage: python check_scorer.py [pricing.csv]
+
+import os
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from export_scorer import compile_pipeline
+from search import build_pipeline
+
+DATASET = "get_around_pricing_project.csv"
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+
+# The scorer checked is the one the API serves
+sys.path.insert(0, API_DIR)
+from fast_scorer import FastScorer
+
+features_list = ['model_key', 'mileage', 'engine_power', 'fuel',
+       'paint_color', 'car_type', 'private_parking_available', 'has_gps',
+       'has_air_conditioning', 'automatic_car', 'has_getaround_connect',
+       'has_speed_regulator', 'winter_tires']
+categorical_features = ['model_key', 'fuel', 'paint_color', 'car_type',
+       'private_parking_available', 'has_gps', 'has_air_conditioning',
+       'automatic_car', 'has_getaround_connect', 'has_speed_regulator', 'winter_tires']
+numerical_features = ['mileage', 'engine_power']
+target_variable = 'rental_price_per_day'
+
+TRIALS = [
+    {'regressor': 'LinearRegression', 'drop': 'first'},
+    {'regressor': 'LinearRegression', 'drop': None},
+    {'regressor': 'Ridge', 'alpha': 1, 'drop': 'first'},
+]
+
+
+def unknown_rows(data):
+    # Each row has one category never seen at fit time, the others are kept
+    rows = data.head(len(categorical_features)).copy().reset_index(drop=True)
+    for i, column in enumerate(['model_key', 'fuel', 'paint_color', 'car_type']):
+        rows[column] = rows[column].astype(object)
+        rows.loc[i, column] = f"unknown {column}"
+    rows.loc[4:, 'model_key'] = "unknown model_key"
+    return rows
+
+
+def check(trial, train, test):
+    pipeline = build_pipeline(trial, categorical_features, numerical_features)
+    pipeline.fit(train[features_list], train[target_variable])
+    scorer = FastScorer(compile_pipeline(pipeline))
+
+    with warnings.catch_warnings():
+        # Unknown categories encoded as zeros are reported with a warning when drop is set
+        warnings.simplefilter("ignore", UserWarning)
+        expected = pipeline.predict(test[features_list])
+    rows = test[features_list].to_dict(orient="records")
+    np.testing.assert_allclose(scorer.predict(rows), expected, rtol=1e-9, atol=1e-6)
+    np.testing.assert_allclose(scorer.predict(test[features_list]), expected, rtol=1e-9, atol=1e-6)
+    np.testing.assert_allclose([scorer.predict_one(row) for row in rows], expected, rtol=1e-9, atol=1e-6)
+
+
+if __name__ == "__main__":
+    data = pd.read_csv(sys.argv[1] if len(sys.argv) > 1 else DATASET)
+    # Some categories only appear in the held out rows, like new values sent to the API
+    train = data.sample(frac=0.8, random_state=0)
+    test = pd.concat([data.drop(train.index), unknown_rows(data)], ignore_index=True)
+
+    for trial in TRIALS:
+        check(trial, train, test)
+        print(f"Parity OK for {trial} on {len(test)} rows, {len(unknown_rows(data))} with unknown categories")
@@ -0,0 +1,136 @@
+# Offline checks of the background logger and of the sync, no tracking server needed
+#
+# The logger is first run against a fake client that answers slowly and
+# records every call: logging calls must return at once, runs created with
+# create_run must be usable before they exist (as a run id and as a parent run
+# tag), values must arrive in log_batch calls within the MLflow limits and
+# before their run is terminated, and a failing client must not block. The
+# same calls are then sent to a real SQLite store (the default backend of
+# tracking.py) in a temporary directory, synced to a second one twice (the
+# second sync copies nothing).
+#
+# Usage: python check_tracking.py
+
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+from mlflow.tracking import MlflowClient
+
+from search import log_trials
+from tracking import BackgroundLogger, PARENT_RUN_TAG, sync
+
+LATENCY = 0.05
+
+SUMMARIES = [
+    {'trial': {'regressor': 'LinearRegression', 'drop': 'first'}, 'cv_r2_mean': 0.7, 'cv_r2_std': 0.01, 'cv_fit_time': 1.0},
+    {'trial': {'regressor': 'Ridge', 'alpha': 1, 'drop': None}, 'cv_r2_mean': 0.69, 'cv_r2_std': 0.02, 'cv_fit_time': 2.0},
+]
+
+
+class FakeClient:
+    """
+    Records the calls of the logger, every call takes LATENCY seconds like a remote server
+    """
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+        self.tags = {}
+
+    def create_run(self, experiment_id, run_name=None, tags=None):
+        time.sleep(LATENCY)
+        if self.fail:
+            raise ConnectionError("tracking server unreachable")
+        run_id = f"run-{len(self.tags)}"
+        self.tags[run_id] = dict(tags or {})
+        self.calls.append(('create', run_id))
+        return SimpleNamespace(info=SimpleNamespace(run_id=run_id))
+
+    def log_batch(self, run_id, metrics=(), params=(), tags=()):
+        time.sleep(LATENCY)
+        assert len(metrics) <= BackgroundLogger.MAX_METRICS and len(params) <= BackgroundLogger.MAX_PARAMS
+        self.calls.append(('batch', run_id, list(metrics), list(params), list(tags)))
+
+    def set_terminated(self, run_id, status="FINISHED"):
+        time.sleep(LATENCY)
+        self.calls.append(('terminate', run_id, status))
+
+
+def check_fake_client():
+    client = FakeClient()
+    logger = BackgroundLogger(client=client, flush_interval=0.1)
+
+    start_time = time.perf_counter()
+    parent = logger.create_run("0")
+    log_trials(SUMMARIES, parent, "0", logger)
+    many = logger.create_run("0", run_name="many metrics")
+    logger.log_metrics(many, {f"metric_{i}": i for i in range(1500)})
+    logger.set_tags(many, {"source": parent})
+    logger.terminate(many)
+    elapsed = time.perf_counter() - start_time
+    # Nothing waited for the client, which takes LATENCY per call
+    assert elapsed < LATENCY, f"logging calls took {elapsed:.3f} s"
+
+    logger.close()
+    assert not logger.errors, logger.errors
+    parent_id = parent.result()
+
+    trials = [run_id for run_id, tags in client.tags.items() if tags.get(PARENT_RUN_TAG) == parent_id]
+    assert len(trials) == len(SUMMARIES), client.tags
+    for run_id in trials + [many.result()]:
+        batches = [call for call in client.calls if call[0] == 'batch' and call[1] == run_id]
+        terminated = [i for i, call in enumerate(client.calls) if call[0] == 'terminate' and call[1] == run_id]
+        assert len(terminated) == 1 and all(client.calls.index(batch) < terminated[0] for batch in batches)
+    params = {param.key for call in client.calls if call[0] == 'batch' and call[1] in trials for param in call[3]}
+    assert {'regressor', 'drop', 'alpha'} <= params, params
+    many_batches = [call for call in client.calls if call[0] == 'batch' and call[1] == many.result()]
+    assert sum(len(call[2]) for call in many_batches) == 1500 and len(many_batches) >= 2
+    assert [tag.value for call in many_batches for tag in call[4]] == [parent_id]
+    print(f"Fake client: {len(client.calls)} calls sent in the background, logging returned in {elapsed * 1000:.1f} ms")
+
+
+def check_failing_client():
+    logger = BackgroundLogger(client=FakeClient(fail=True), flush_interval=0.1)
+    parent = logger.create_run("0")
+    log_trials(SUMMARIES, parent, "0", logger)
+    logger.close()
+    assert parent.exception() is not None and logger.errors
+    print(f"Failing client: {len(logger.errors)} errors kept, close() returned")
+
+
+def check_local_store(directory):
+    local_uri = f"sqlite:///{os.path.join(directory, 'local.db')}"
+    remote_uri = f"sqlite:///{os.path.join(directory, 'remote.db')}"
+    client = MlflowClient(tracking_uri=local_uri)
+    experiment_id = client.create_experiment("get_around_expirement", artifact_location=os.path.join(directory, 'artifacts'))
+
+    logger = BackgroundLogger(client=client, flush_interval=0.1)
+    parent = logger.create_run(experiment_id, run_name="parent")
+    log_trials(SUMMARIES, parent, experiment_id, logger)
+    logger.terminate(parent)
+    logger.close()
+    assert not logger.errors, logger.errors
+
+    runs = client.search_runs([experiment_id])
+    children = [run for run in runs if run.data.tags.get(PARENT_RUN_TAG) == parent.result()]
+    assert len(runs) == len(SUMMARIES) + 1 and len(children) == len(SUMMARIES)
+    assert all(run.info.status == "FINISHED" and 'cv_r2_mean' in run.data.metrics for run in children)
+
+    assert sync(local_uri, remote_uri) == len(runs)
+    assert sync(local_uri, remote_uri) == 0
+    remote = MlflowClient(tracking_uri=remote_uri)
+    remote_runs = remote.search_runs([remote.get_experiment_by_name("get_around_expirement").experiment_id])
+    remote_parent = [run for run in remote_runs if PARENT_RUN_TAG not in run.data.tags]
+    assert len(remote_runs) == len(runs) and len(remote_parent) == 1
+    assert all(run.data.tags[PARENT_RUN_TAG] == remote_parent[0].info.run_id for run in remote_runs if run not in remote_parent)
+    print(f"Local store: {len(runs)} runs logged and synced once to a second store")
+
+
+if __name__ == "__main__":
+    check_fake_client()
+    check_failing_client()
+    with tempfile.TemporaryDirectory() as directory:
+        check_local_store(directory)
+    print("Tracking checks OK")
@@ -0,0 +1,74 @@
+# Compile the fitted pricing pipeline into a compact scoring artifact
+#
+# The pipeline is OneHotEncoder + StandardScaler + LinearRegression, so a
+# prediction is only the intercept plus one weight per category and one
+# scaled term per numerical feature. The artifact keeps exactly that and can
+# be scored by the API without sklearn nor pandas (see api/fast_scorer.py).
+#
+# Usage: python export_scorer.py <model_uri> [output.json]
+
+import json
+import sys
+
+# Name of the artifact logged next to the model by train.py
+SCORER_ARTIFACT = "fast_scorer.json"
+
+
+def compile_pipeline(model):
+    """
+    Turn a fitted pricing Pipeline into lookup tables, scaler stats and intercept
+    """
+    preprocessing = model.named_steps["Preprocessing"]
+    regressor = model.named_steps["Regressor"]
+    coefs = regressor.coef_.ravel()
+
+    transformers = {name: (transformer, columns) for name, transformer, columns in preprocessing.transformers_}
+    encoder, categorical_features = transformers["cat"]
+    scaler, numerical_features = transformers["num"]
+
+    # ColumnTransformer outputs the encoded categories first, then the scaled numericals
+    position = 0
+    categorical = {}
+    for i, (feature, categories) in enumerate(zip(categorical_features, encoder.categories_)):
+        dropped = None if encoder.drop_idx_ is None else encoder.drop_idx_[i]
+        table = {}
+        for j, category in enumerate(categories):
+            if j == dropped:
+                # Dropped category is the reference, it weighs nothing
+                table[str(category)] = 0.0
+                continue
+            table[str(category)] = float(coefs[position])
+            position += 1
+        categorical[feature] = table
+
+    numerical = {}
+    for i, feature in enumerate(numerical_features):
+        numerical[feature] = {
+            "mean": float(scaler.mean_[i]),
+            "scale": float(scaler.scale_[i]),
+            "coef": float(coefs[position]),
+        }
+        position += 1
+
+    if position != len(coefs):
+        raise ValueError(f"{len(coefs)} coefficients found but {position} were mapped to features")
+
+    return {
+        "features": list(categorical_features) + list(numerical_features),
+        "intercept": float(regressor.intercept_),
+        "categorical": categorical,
+        "numerical": numerical,
+    }
+
+
+if __name__ == "__main__":
+    import mlflow
+
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python export_scorer.py <model_uri> [output.json]")
+
+    model = mlflow.sklearn.load_model(sys.argv[1])
+    output = sys.argv[2] if len(sys.argv) > 2 else SCORER_ARTIFACT
+    with open(output, "w") as f:
+        json.dump(compile_pipeline(model), f, indent=2)
+    print(f"Scorer written to {output}")
@@ -0,0 +1,122 @@
+# Schema of the pricing data, shared by training (model-MLFlow) and the API
+#
+# This file is the only copy: the API image gets it at build time (see
+# api/Dockerfile) and the API run locally finds it with
+# PYTHONPATH=../model-MLFlow. train.py tags the model with schema_hash().
+#
+# Every column has an explicit compact dtype: the car descriptions are
+# categoricals with a fixed vocabulary, the options are bools and the numbers
+# int32. Only the features and the target are read. The model signature is
+# still inferred from plain_frame(), the dtypes sent to the API. Loading the
+# CSV through load() also keeps a typed Parquet copy next to it, read instead
+# of parsing the CSV again while the CSV is unchanged.
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+VOCABULARY = {
+    'model_key': ['Alfa Romeo', 'Audi', 'BMW', 'Citroën', 'Ferrari', 'Fiat', 'Ford', 'Honda', 'KIA Motors',
+                  'Lamborghini', 'Lexus', 'Maserati', 'Mazda', 'Mercedes', 'Mini', 'Mitsubishi', 'Nissan', 'Opel',
+                  'PGO', 'Peugeot', 'Porsche', 'Renault', 'SEAT', 'Subaru', 'Suzuki', 'Toyota', 'Volkswagen',
+                  'Yamaha'],
+    'fuel': ['diesel', 'electro', 'hybrid_petrol', 'petrol'],
+    'paint_color': ['beige', 'black', 'blue', 'brown', 'green', 'grey', 'orange', 'red', 'silver', 'white'],
+    'car_type': ['convertible', 'coupe', 'estate', 'hatchback', 'sedan', 'subcompact', 'suv', 'van'],
+}
+
+BOOLEAN_FEATURES = ['private_parking_available', 'has_gps', 'has_air_conditioning', 'automatic_car',
+                    'has_getaround_connect', 'has_speed_regulator', 'winter_tires']
+
+# Columns in the order used at training time
+features_list = ['model_key', 'mileage', 'engine_power', 'fuel',
+       'paint_color', 'car_type', 'private_parking_available', 'has_gps',
+       'has_air_conditioning', 'automatic_car', 'has_getaround_connect',
+       'has_speed_regulator', 'winter_tires']
+categorical_features = ['model_key', 'fuel', 'paint_color', 'car_type'] + BOOLEAN_FEATURES
+numerical_features = ['mileage', 'engine_power']
+target_variable = 'rental_price_per_day'
+
+DTYPES = {
+    **{column: pd.CategoricalDtype(categories) for column, categories in VOCABULARY.items()},
+    **{column: 'bool' for column in BOOLEAN_FEATURES},
+    'mileage': 'int32',
+    'engine_power': 'int32',
+    target_variable: 'int32',
+}
+
+
+def schema_hash():
+    # Changes with the vocabulary or the dtypes, cached Parquet files of another schema are not reused
+    payload = json.dumps({column: str(dtype) if column not in VOCABULARY else VOCABULARY[column]
+                          for column, dtype in DTYPES.items()}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:8]
+
+
+def unknown_values(raw, column):
+    values = raw[column].dropna().unique()
+    return sorted(set(values) - set(VOCABULARY[column]))
+
+
+def conform(data, target=True, strict=True, source='the data'):
+    """
+    Features (and target) of a frame read from any format, with the schema dtypes.
+
+    Missing columns raise a ValueError. Values outside the vocabulary raise a
+    ValueError when strict, otherwise they are read as missing and the model
+    ignores them like unknown values.
+    """
+    columns = features_list + ([target_variable] if target else [])
+    missing = [column for column in columns if column not in data.columns]
+    if missing:
+        raise ValueError(f"Columns missing in {source}: {missing}")
+    if strict:
+        unknown = {column: values for column in VOCABULARY if (values := unknown_values(data, column))}
+        if unknown:
+            raise ValueError(f"Values outside the schema vocabulary in {source}: {unknown}")
+    return data[columns].astype({column: DTYPES[column] for column in columns})
+
+
+def read_csv(path, target=True, strict=True):
+    """
+    Read the features (and the target) of a pricing CSV with the schema dtypes, see conform()
+    """
+    columns = features_list + ([target_variable] if target else [])
+    # Categories are read as their own values first to find the unknown ones
+    data = pd.read_csv(path, usecols=columns,
+                       dtype={column: 'category' if column in VOCABULARY else DTYPES[column] for column in columns})
+    return conform(data, target, strict, source=path)
+
+
+def plain_frame(data):
+    """
+    Same frame with the dtypes of the model signature (strings and int64), as pyfunc enforces them.
+    Missing categories stay missing (None), the model ignores them like unknown values.
+    """
+    plain = data.astype({column: 'int64' for column in data if str(data[column].dtype) == 'int32'})
+    for column in VOCABULARY:
+        if column in plain:
+            values = plain[column].astype(object)
+            plain[column] = values.where(values.notna(), None)
+    return plain
+
+
+def cache_path(path):
+    return f"{os.path.splitext(path)[0]}.{schema_hash()}.parquet"
+
+
+def load(path, cache=True):
+    """
+    Typed features and target of a pricing CSV, from its Parquet copy when it is up to date
+    """
+    if not cache:
+        return read_csv(path)
+    parquet = cache_path(path)
+    if os.path.exists(parquet) and os.path.getmtime(parquet) >= os.path.getmtime(path):
+        return pd.read_parquet(parquet)
+    data = read_csv(path)
+    data.to_parquet(parquet + '.tmp', index=False)
+    os.replace(parquet + '.tmp', parquet)
+    return data
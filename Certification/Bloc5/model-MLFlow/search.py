@@ -0,0 +1,190 @@
+# Hyperparameter search for the pricing model
+#
+# Every (trial, fold) pair is an independent task run on all cores with
+# joblib. Each finished fold is appended to a checkpoint file named after the
+# training data hash and the KFold split (seed and number of folds), so a
+# killed search restarts where it stopped and another split starts afresh. Trials are
+# logged to MLflow as nested runs once the search is over, in batches sent by
+# the background logger of tracking.py.
+#
+# Only the regressor changes between most trials, so the preprocessing is
+# fitted once per fold and encoder option: the encoded design matrices are
+# stored in a cache directory, keyed on the data hash, the encoder options and
+# the fold, and every trial of that fold reads them back.
+
+import hashlib
+import json
+import os
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.compose import ColumnTransformer
+from sklearn.linear_model import LinearRegression, Ridge, Lasso
+from sklearn.metrics import r2_score
+from sklearn.model_selection import KFold
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+from tracking import PARENT_RUN_TAG
+
+REGRESSORS = {
+    'LinearRegression': LinearRegression,
+    'Ridge': Ridge,
+    'Lasso': Lasso,
+}
+
+
+def param_grid():
+    """
+    Model family, regularization strength and encoder options to try
+    """
+    trials = []
+    for drop in ['first', None]:
+        trials.append({'regressor': 'LinearRegression', 'drop': drop})
+        for alpha in [0.01, 0.1, 1, 10, 100]:
+            trials.append({'regressor': 'Ridge', 'alpha': alpha, 'drop': drop})
+            trials.append({'regressor': 'Lasso', 'alpha': alpha, 'drop': drop})
+    return trials
+
+
+def trial_key(trial):
+    return json.dumps(trial, sort_keys=True)
+
+
+def build_preprocessor(trial, categorical_features, numerical_features):
+    return ColumnTransformer(
+        transformers=[
+            ('cat', OneHotEncoder(drop=trial['drop'], handle_unknown='ignore'), categorical_features),
+            ('num', StandardScaler(), numerical_features)
+            ]
+        )
+
+
+def build_regressor(trial):
+    if trial['regressor'] == 'LinearRegression':
+        return LinearRegression()
+    if trial['regressor'] == 'Lasso':
+        return Lasso(alpha=trial['alpha'], max_iter=10000)
+    return REGRESSORS[trial['regressor']](alpha=trial['alpha'])
+
+
+def build_pipeline(trial, categorical_features, numerical_features, memory=None):
+    # With a memory directory the fitted preprocessing is reused by later fits on the same data
+    return Pipeline(steps=[("Preprocessing", build_preprocessor(trial, categorical_features, numerical_features)),
+                           ("Regressor", build_regressor(trial))
+                           ],
+                    memory=memory)
+
+
+def encoded_path(cache_dir, data_key, trial, fold, folds):
+    return os.path.join(cache_dir, f"encoded_{data_key}_drop={trial['drop']}_fold={fold}of{folds}.joblib")
+
+
+def encode_fold(path, trial, X, train_index, test_index, categorical_features, numerical_features):
+    # Runs in a worker process, fits the preprocessing of one fold and stores the sparse design matrices
+    preprocessor = build_preprocessor(trial, categorical_features, numerical_features)
+    X_train = preprocessor.fit_transform(X.iloc[train_index])
+    X_test = preprocessor.transform(X.iloc[test_index])
+    joblib.dump((X_train, X_test), path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def fit_fold(trial, fold, path, Y, train_index, test_index):
+    # Runs in a worker process, only the regressor is fitted
+    start_time = time.time()
+    X_train, X_test = joblib.load(path)
+    regressor = build_regressor(trial)
+    regressor.fit(X_train, Y.iloc[train_index])
+    r2 = r2_score(Y.iloc[test_index], regressor.predict(X_test))
+    return {'trial': trial_key(trial), 'fold': fold, 'r2': r2, 'fit_time': time.time() - start_time}
+
+
+def data_hash(X, Y):
+    hashes = pd.util.hash_pandas_object(pd.concat([X, Y], axis=1), index=False)
+    return hashlib.sha256(hashes.to_numpy().tobytes()).hexdigest()[:12]
+
+
+def read_checkpoint(path):
+    done = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # Last line cut when the run was killed
+                    continue
+                done[(result['trial'], result['fold'])] = result
+    return done
+
+
+def run_search(X, Y, categorical_features, numerical_features, trials=None,
+               n_jobs=-1, folds=5, checkpoint_dir='.', cache_dir='search_cache', random_state=20):
+    """
+    Cross validate every trial in parallel and return their scores, best first
+    """
+    trials = trials or param_grid()
+    data_key = data_hash(X, Y)
+    # Fold scores only mean something for the split they were computed on
+    split_key = f'{data_key}_seed={random_state}'
+    checkpoint = os.path.join(checkpoint_dir, f'search_checkpoint_{split_key}_folds={folds}.jsonl')
+    done = read_checkpoint(checkpoint)
+
+    splits = list(KFold(n_splits=folds, shuffle=True, random_state=random_state).split(X))
+    tasks = [(trial, fold) for trial in trials for fold in range(folds)
+             if (trial_key(trial), fold) not in done]
+    print(f"{len(trials) * folds - len(tasks)} folds restored from {checkpoint}, {len(tasks)} to run")
+
+    # Encode each fold once per encoder option needed by the remaining tasks
+    os.makedirs(cache_dir, exist_ok=True)
+    encodings = {}
+    for trial, fold in tasks:
+        path = encoded_path(cache_dir, split_key, trial, fold, folds)
+        if not os.path.exists(path):
+            encodings[path] = (trial, fold)
+    print(f"{len(encodings)} fold encodings to compute")
+    Parallel(n_jobs=n_jobs)(
+        delayed(encode_fold)(path, trial, X, *splits[fold], categorical_features, numerical_features)
+        for path, (trial, fold) in encodings.items()
+    )
+
+    with open(checkpoint, 'a') as f:
+        results = Parallel(n_jobs=n_jobs, return_as='generator_unordered')(
+            delayed(fit_fold)(trial, fold, encoded_path(cache_dir, split_key, trial, fold, folds), Y, *splits[fold])
+            for trial, fold in tasks
+        )
+        for result in results:
+            # Saved as soon as it is done, a killed run loses only the running folds
+            f.write(json.dumps(result) + '\n')
+            f.flush()
+            done[(result['trial'], result['fold'])] = result
+
+    summaries = []
+    for trial in trials:
+        scores = [done[(trial_key(trial), fold)] for fold in range(folds)]
+        r2 = np.array([score['r2'] for score in scores])
+        summaries.append({
+            'trial': trial,
+            'cv_r2_mean': r2.mean(),
+            'cv_r2_std': r2.std(),
+            'cv_fit_time': sum(score['fit_time'] for score in scores),
+        })
+    return sorted(summaries, key=lambda summary: summary['cv_r2_mean'], reverse=True)
+
+
+def log_trials(summaries, parent_run, experiment_id, logger):
+    """
+    Log every trial as a nested run of the parent run (a run id or a Future of
+    BackgroundLogger.create_run), runs, params and metrics all go through the
+    background logger
+    """
+    for summary in summaries:
+        trial = summary['trial']
+        name = trial['regressor'] + (f"_alpha={trial['alpha']}" if 'alpha' in trial else '') + f"_drop={trial['drop']}"
+        run = logger.create_run(experiment_id, run_name=name, tags={PARENT_RUN_TAG: parent_run})
+        logger.log_params(run, trial)
+        logger.log_metrics(run, {key: value for key, value in summary.items() if key != 'trial'})
+        logger.terminate(run)
@@ -0,0 +1,208 @@
+# MLflow tracking configuration, background logging and sync to a remote server
+#
+# Runs are tracked in a local SQLite store by default, so training never waits
+# for the network and works fully offline. MLFLOW_TRACKING_URI (or
+# --tracking-uri in train.py) selects another backend. Local runs are pushed
+# to the remote server later with:
+#
+#   python tracking.py sync [--from sqlite:///mlflow.db] [--to https://...] [--experiment NAME]
+
+import argparse
+import os
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+from mlflow.entities import Metric, Param, RunTag
+from mlflow.tracking import MlflowClient
+
+DEFAULT_TRACKING_URI = "sqlite:///mlflow.db"
+REMOTE_TRACKING_URI = "https://getaround-model-server.herokuapp.com/"
+EXPERIMENT_NAME = "get_around_expirement"
+
+# Tags linking a local run and its copy on the remote server
+SYNCED_TO_TAG = "sync.remote_run_id"
+SYNCED_FROM_TAG = "sync.local_run_id"
+PARENT_RUN_TAG = "mlflow.parentRunId"
+
+
+def tracking_uri(uri=None):
+    return uri or os.environ.get("MLFLOW_TRACKING_URI", DEFAULT_TRACKING_URI)
+
+
+class BackgroundLogger:
+    """
+    Create runs and queue params, metrics and tags, sent with log_batch from a thread.
+
+    Calls return immediately. create_run returns a Future of the run id, it
+    can be given wherever a run id is expected (parent run tag included) and
+    is resolved by the thread. Pending values of a run are sent together when
+    the batch is full, every flush_interval seconds, before the run is
+    terminated and on close.
+    """
+
+    # Limits of one log_batch call
+    MAX_METRICS = 1000
+    MAX_PARAMS = 100
+
+    def __init__(self, client=None, flush_interval=2.0):
+        self.client = client or MlflowClient()
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.pending = {}
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def create_run(self, experiment_id, run_name=None, tags=None):
+        run = Future()
+        self.queue.put(('create', run, (experiment_id, run_name, tags or {})))
+        return run
+
+    def log_params(self, run_id, params):
+        self.queue.put(('params', run_id, [Param(key, str(value)) for key, value in params.items()]))
+
+    def log_metrics(self, run_id, metrics, step=0):
+        timestamp = int(time.time() * 1000)
+        self.queue.put(('metrics', run_id, [Metric(key, float(value), timestamp, step) for key, value in metrics.items()]))
+
+    def set_tags(self, run_id, tags):
+        self.queue.put(('tags', run_id, [RunTag(key, value if isinstance(value, Future) else str(value)) for key, value in tags.items()]))
+
+    def terminate(self, run_id, status="FINISHED"):
+        # Processed in order, so everything logged before is sent first
+        self.queue.put(('terminate', run_id, status))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.errors:
+            print(f"{len(self.errors)} logging calls failed, first one: {self.errors[0]}")
+
+    @staticmethod
+    def _resolve(value):
+        # A run created by create_run, known once the thread created it
+        return value.result() if isinstance(value, Future) else value
+
+    def _create(self, run, experiment_id, run_name, tags):
+        try:
+            tags = {key: str(self._resolve(value)) for key, value in tags.items()}
+            created = self.client.create_run(experiment_id, run_name=run_name, tags=tags)
+            run.set_result(created.info.run_id)
+        except Exception as e:
+            self.errors.append(e)
+            run.set_exception(e)
+
+    def _flush(self, run_id):
+        batch = self.pending.pop(run_id, None)
+        if not batch:
+            return
+        metrics, params, tags = batch['metrics'], batch['params'], batch['tags']
+        try:
+            run_id = self._resolve(run_id)
+            tags = [RunTag(tag.key, str(self._resolve(tag.value))) for tag in tags]
+            while metrics or params or tags:
+                self.client.log_batch(run_id, metrics=metrics[:self.MAX_METRICS],
+                                      params=params[:self.MAX_PARAMS], tags=tags[:self.MAX_PARAMS])
+                metrics, params, tags = metrics[self.MAX_METRICS:], params[self.MAX_PARAMS:], tags[self.MAX_PARAMS:]
+        except Exception as e:
+            self.errors.append(e)
+
+    def _run(self):
+        last_flush = time.time()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = False
+
+            if item is None:
+                for run_id in list(self.pending):
+                    self._flush(run_id)
+                return
+            if item:
+                kind, run_id, values = item
+                if kind == 'create':
+                    self._create(run_id, *values)
+                elif kind == 'terminate':
+                    self._flush(run_id)
+                    try:
+                        self.client.set_terminated(self._resolve(run_id), values)
+                    except Exception as e:
+                        self.errors.append(e)
+                else:
+                    batch = self.pending.setdefault(run_id, {'metrics': [], 'params': [], 'tags': []})
+                    batch[kind].extend(values)
+                    if len(batch['metrics']) >= self.MAX_METRICS:
+                        self._flush(run_id)
+
+            if time.time() - last_flush >= self.flush_interval:
+                for run_id in list(self.pending):
+                    self._flush(run_id)
+                last_flush = time.time()
+
+
+def sync(local_uri, remote_uri, experiment_name=EXPERIMENT_NAME):
+    """
+    Copy the finished local runs not synced yet to the remote server, with their artifacts
+    """
+    local = MlflowClient(tracking_uri=local_uri)
+    remote = MlflowClient(tracking_uri=remote_uri)
+
+    experiment = local.get_experiment_by_name(experiment_name)
+    if experiment is None:
+        print(f"No local experiment named {experiment_name}")
+        return 0
+    remote_experiment = remote.get_experiment_by_name(experiment_name)
+    remote_experiment_id = remote_experiment.experiment_id if remote_experiment else remote.create_experiment(experiment_name)
+
+    # Oldest first so parents are copied before their nested runs
+    runs = local.search_runs([experiment.experiment_id], filter_string="attributes.status != 'RUNNING'",
+                             order_by=["attributes.start_time ASC"], max_results=50000)
+    remote_ids = {run.info.run_id: run.data.tags[SYNCED_TO_TAG] for run in runs if SYNCED_TO_TAG in run.data.tags}
+
+    synced = 0
+    for run in runs:
+        if run.info.run_id in remote_ids:
+            continue
+        tags = {key: value for key, value in run.data.tags.items() if key != SYNCED_TO_TAG}
+        if PARENT_RUN_TAG in tags:
+            tags[PARENT_RUN_TAG] = remote_ids.get(tags[PARENT_RUN_TAG], tags[PARENT_RUN_TAG])
+        tags[SYNCED_FROM_TAG] = run.info.run_id
+
+        remote_run = remote.create_run(remote_experiment_id, start_time=run.info.start_time, tags=tags)
+        remote_id = remote_run.info.run_id
+
+        metrics = []
+        for key in run.data.metrics:
+            metrics.extend(local.get_metric_history(run.info.run_id, key))
+        params = [Param(key, value) for key, value in run.data.params.items()]
+        for start in range(0, max(len(metrics), len(params), 1), 100):
+            remote.log_batch(remote_id, metrics=metrics[start:start + 100], params=params[start:start + 100])
+
+        with tempfile.TemporaryDirectory() as directory:
+            if local.list_artifacts(run.info.run_id):
+                local.download_artifacts(run.info.run_id, "", directory)
+                remote.log_artifacts(remote_id, directory)
+
+        remote.set_terminated(remote_id, run.info.status, end_time=run.info.end_time)
+        local.set_tag(run.info.run_id, SYNCED_TO_TAG, remote_id)
+        remote_ids[run.info.run_id] = remote_id
+        synced += 1
+        print(f"Run {run.info.run_id} synced as {remote_id}")
+    return synced
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Push local MLflow runs to a remote tracking server")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sync_parser = subparsers.add_parser("sync", help="copy the local runs not synced yet")
+    sync_parser.add_argument("--from", dest="local_uri", default=DEFAULT_TRACKING_URI)
+    sync_parser.add_argument("--to", dest="remote_uri", default=REMOTE_TRACKING_URI)
+    sync_parser.add_argument("--experiment", default=EXPERIMENT_NAME)
+    args = parser.parse_args()
+
+    count = sync(args.local_uri, args.remote_uri, args.experiment)
+    print(f"{count} runs synced to {args.remote_uri}")
@@ -1,8 +1,8 @@
 # Libraries import
 
-import pandas as pd
 import numpy as np
 import os
+import argparse
 import mlflow
 from mlflow.models.signature import infer_signature
 
@@ -17,10 +17,32 @@ from sklearn.linear_model import Ridge, Lasso
 from sklearn.model_selection import cross_val_score, GridSearchCV
 from sklearn.pipeline import Pipeline
 
+from export_scorer import compile_pipeline, SCORER_ARTIFACT
+from search import run_search, log_trials, build_pipeline
+from tracking import tracking_uri, BackgroundLogger
+
+# The data schema is shared with the API, which gets this file at build time
+import schema
+from schema import features_list, categorical_features, numerical_features, target_variable
+
 
 import time
 
 
+# Command line options
+parser = argparse.ArgumentParser(description="Train the GetAround pricing model")
+parser.add_argument("--search", action="store_true",
+                    help="cross validate LinearRegression, Ridge and Lasso with several encoder options and keep the best")
+parser.add_argument("--jobs", type=int, default=-1, help="parallel jobs of the search, all cores by default")
+parser.add_argument("--folds", type=int, default=5, help="cross validation folds of the search")
+parser.add_argument("--cache-dir", default="search_cache", help="where fitted preprocessing is cached between trials")
+parser.add_argument("--data", default="get_around_pricing_project.csv", help="pricing CSV")
+parser.add_argument("--no-parquet-cache", action="store_true", help="parse the CSV even when its typed Parquet copy is up to date")
+parser.add_argument("--tracking-uri", default=None,
+                    help="MLflow backend, MLFLOW_TRACKING_URI or the local sqlite:///mlflow.db by default (push to the server with tracking.py sync)")
+args = parser.parse_args()
+
+
 # Set your variables for your environment
 EXPERIMENT_NAME="get_around_expirement"
 
@@ -28,9 +50,8 @@ EXPERIMENT_NAME="get_around_expirement"
 client = mlflow.tracking.MlflowClient()
 
 
-APP_URI = "https://getaround-model-server.herokuapp.com/"
-
-mlflow.set_tracking_uri(APP_URI)
+# Local store by default, training does not wait for the remote server
+mlflow.set_tracking_uri(tracking_uri(args.tracking_uri))
 
 
 # Set experiment's info 
@@ -40,11 +61,16 @@ mlflow.set_experiment(EXPERIMENT_NAME)
 experiment = mlflow.get_experiment_by_name(EXPERIMENT_NAME)
 #run = client.create_run(experiment.experiment_id) # Creates a new run for a given experiment
 
+# Runs are created and logged by a background thread, the parent run is created while the data loads
+logger = BackgroundLogger()
+parent_run = logger.create_run(experiment.experiment_id)
+
 
 #dataset import
 
 print("Loading dataset...")
-data = pd.read_csv("get_around_pricing_project.csv")
+# Typed columns (categories, bools, int32) read from the Parquet copy when the CSV did not change
+data = schema.load(args.data, cache=not args.no_parquet_cache)
 print("...Done.")
 print()
 
@@ -52,13 +78,6 @@ print()
 
 print("Separating labels from features...")
 
-features_list = [ 'model_key', 'mileage', 'engine_power', 'fuel',
-       'paint_color', 'car_type', 'private_parking_available', 'has_gps',
-       'has_air_conditioning', 'automatic_car', 'has_getaround_connect',
-       'has_speed_regulator', 'winter_tires']
-       
-target_variable =  'rental_price_per_day'
-
 X = data.loc[:,features_list]
 Y = data.loc[:,target_variable]
 print()
@@ -77,13 +96,6 @@ print()
 # Encoding categorical features and standardizing numerical features
 
 
-categorical_features = [ 'model_key', 'fuel',
-       'paint_color', 'car_type', 'private_parking_available', 'has_gps',
-       'has_air_conditioning', 'automatic_car', 'has_getaround_connect',
-       'has_speed_regulator', 'winter_tires']
-
-numerical_features = [ 'mileage', 'engine_power']
-
 
 numeric_transformer = StandardScaler()
 categorical_transformer = OneHotEncoder(drop='first',handle_unknown='ignore')
@@ -91,7 +103,8 @@ categorical_transformer = OneHotEncoder(drop='first',handle_unknown='ignore')
 # Time execution
 start_time = time.time()
 
-#Calling autolog
+#Calling autolog, its params and metrics are sent by the MLflow async logging queue
+mlflow.config.enable_async_logging()
 mlflow.sklearn.autolog()
 
 featureencoder = ColumnTransformer(
@@ -105,8 +118,23 @@ model = Pipeline(steps=[("Preprocessing", featureencoder),
                             ("Regressor", LinearRegression())
                             ])
 
-    # Log experiment to MLFlow
-with mlflow.start_run():
+# Hyperparameter search, the best trial replaces the default model
+if args.search:
+    print("Searching hyperparameters...")
+    summaries = run_search(X_train, Y_train, categorical_features, numerical_features,
+                           n_jobs=args.jobs, folds=args.folds, cache_dir=args.cache_dir)
+    best = summaries[0]
+    print(f"...Done! Best trial {best['trial']} with a mean R2 of {best['cv_r2_mean']:.4f}")
+    # No memory: the cache is for the search only, a cache path pickled in the logged model would be used when serving
+    model = build_pipeline(best['trial'], categorical_features, numerical_features, memory=None)
+
+    # Nested trial runs are sent in batches by the background thread
+    log_trials(summaries, parent_run, experiment.experiment_id, logger)
+
+    # Log experiment to MLFlow, only the model logging waits for the parent run, its creation was queued first
+with mlflow.start_run(run_id=parent_run.result()) as run:
+        # Schema the model was trained with
+        mlflow.set_tag("schema_hash", schema.schema_hash())
         model.fit(X_train, Y_train)
         predictions = model.predict(X_train)
 
@@ -115,8 +143,14 @@ with mlflow.start_run():
             sk_model=model,
             artifact_path="pricing_cars_predictor",
             registered_model_name="pricing_cars_linearReg",
-            signature=infer_signature(X_train, predictions)
+            # Signature of what the API sends: strings and int64, not the compact training dtypes
+            signature=infer_signature(schema.plain_frame(X_train), predictions)
             )
 
+    # Log the compiled scorer next to the model for the API fast scoring mode
+        mlflow.log_dict(compile_pipeline(model), f"pricing_cars_predictor/{SCORER_ARTIFACT}")
+
+        logger.close()
+
         print("...Done!")
         print(f"---Total training time: {time.time()-start_time}")
\ No newline at end of file
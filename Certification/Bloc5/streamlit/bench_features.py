@@ -0,0 +1,56 @@
+# Benchmark of the late / delta columns derivation on a synthetic dataset
+#
+# Compares the former row-wise apply(lambda) with the vectorized categorical
+# derivation used in metrics.py, and the value_counts that follow.
+#
+# Usage: python bench_features.py [rentals]
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from metrics import late_column, delta_column
+
+
+def synthetic_rentals(size, seed=0):
+    rng = np.random.default_rng(seed)
+    delay = rng.normal(60, 300, size).round()
+    # Around 20% of the delays are unknown and 90% of the time deltas are above 12 hours
+    delay[rng.random(size) < 0.2] = np.nan
+    time_delta = rng.integers(0, 24, size) * 30.0
+    time_delta[rng.random(size) < 0.9] = np.nan
+    return pd.DataFrame({
+        'delay_at_checkout_in_minutes': delay,
+        'time_delta_with_previous_rental_in_minutes': time_delta,
+    })
+
+
+def timed(label, function):
+    start_time = time.perf_counter()
+    result = function()
+    print(f"{label:45} {time.perf_counter() - start_time:8.3f} s")
+    return result
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    data = synthetic_rentals(size)
+    print(f"{size} synthetic rentals")
+
+    delay = data['delay_at_checkout_in_minutes']
+    time_delta = data['time_delta_with_previous_rental_in_minutes']
+
+    late_apply = timed("late, apply(lambda)", lambda: delay.apply(lambda x: 'late' if x > 0 else 'in time'))
+    late_vector = timed("late, vectorized categorical", lambda: pd.Series(late_column(delay)))
+    assert (late_apply.to_numpy() == late_vector.astype(str).to_numpy()).all()
+
+    timed("delta, apply(lambda)", lambda: time_delta.isna().apply(lambda x: x if x == False else '> 720 minutes'))
+    timed("delta, vectorized categorical", lambda: pd.Series(delta_column(time_delta)))
+
+    timed("late value_counts, object dtype", lambda: late_apply.value_counts(normalize=True))
+    timed("late value_counts, categorical dtype", lambda: late_vector.value_counts(normalize=True))
+
+    print(f"late column memory, object: {late_apply.memory_usage(deep=True) / 1e6:8.1f} MB")
+    print(f"late column memory, categorical: {late_vector.memory_usage(deep=True) / 1e6:8.1f} MB")
@@ -0,0 +1,223 @@
+# Incremental aggregation store for the append-only rental log
+#
+# Rentals are split in partitions of consecutive rental ids. Each partition
+# persists the compact delay and checkin type of its rentals and the chained
+# rentals that follow one of them (stored in the partition of their previous
+# rental, so every chain is joined inside one partition). The store also
+# persists the merged aggregates of all the rentals (the DelayAggregates of
+# streaming.py: counts, sums, histogram bins and quantile sketches) and the
+# chain aggregates of each partition.
+#
+# A new batch of rentals is folded into the merged aggregates, and only the
+# partitions it touches, with new rentals or new chained rentals pointing to
+# them, are read and joined again. The dashboard summary is then built from
+# the merged aggregates and the chain aggregates, without reading any
+# partition.
+#
+# Every append is one revision: the partitions it changes and the merged
+# aggregates are written to new files named after the revision, then the
+# manifest naming the files of that revision replaces the previous one. A
+# crash before the manifest is written leaves the previous revision intact,
+# the files of the unfinished revision are ignored and removed later.
+#
+# The dashboard reads the store when DELAY_ANALYSIS_MODE is 'streaming' and
+# DELAY_ANALYSIS_SOURCE is the store directory. It only reads it, the summary
+# is written by ingest() and rebuilt in memory when it is missing.
+#
+# Usage: python incremental.py <store_dir> <rentals.parquet|rentals.csv>
+
+import json
+import os
+import pickle
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+from streaming import LINK_DTYPE, DelayAggregates, read_chunks, rental_records, chain_aggregates, merge_chains, build_summary
+
+PARTITION_SIZE = 50_000
+CHUNK_SIZE = 100_000
+# Layout of the store files, stores of another layout are ingested again in a new directory
+STORE_FORMAT = 3
+# Files of a revision, the ones the manifest does not name are left over by an older or unfinished revision
+REVISION_FILE = re.compile(r'(partition-\d+|totals)-r\d+\.pkl$')
+
+
+class Store:
+
+    def __init__(self, path, partition_size=PARTITION_SIZE):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.manifest = self._read_json('manifest.json') or {
+            'format': STORE_FORMAT,
+            'partition_size': partition_size,
+            'revision': 0,
+            'totals': None,
+            'partitions': {},
+        }
+        if self.manifest.get('format') != STORE_FORMAT:
+            raise ValueError(f"{path} was built with another store format, ingest the rental log in a new directory")
+        self.partition_size = self.manifest['partition_size']
+        self._totals = None
+
+    def _read_json(self, name):
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, name, write, mode='w'):
+        # Write to a temporary file then rename, readers never see a partial file
+        path = os.path.join(self.path, name)
+        with open(path + '.tmp', mode) as f:
+            write(f)
+        os.replace(path + '.tmp', path)
+
+    def version(self):
+        return f"store-{self.manifest['revision']}"
+
+    def _read_pickle(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            return pickle.load(f)
+
+    def load_partition(self, number):
+        entry = self.manifest['partitions'].get(str(number))
+        if entry is not None:
+            return self._read_pickle(entry['file'])
+        return {
+            'records': {
+                'rental_id': np.empty(0, dtype=np.int64),
+                'delay': np.empty(0),
+                'checkin': np.empty(0, dtype=np.int64),
+            },
+            'links': np.empty(0, dtype=LINK_DTYPE),
+        }
+
+    def save_partition(self, number, partition, revision):
+        name = f'partition-{number}-r{revision}.pkl'
+        self._write(name, lambda f: pickle.dump(partition, f), mode='wb')
+        return name
+
+    def totals(self):
+        """
+        Merged aggregates of every rental and chain aggregates by partition number
+        """
+        if self._totals is None:
+            if self.manifest['totals'] is not None:
+                self._totals = self._read_pickle(self.manifest['totals'])
+            else:
+                self._totals = {'aggregates': DelayAggregates(), 'chains': {}}
+        return self._totals
+
+    def _remove_unused(self):
+        # Files of the previous revisions and of an unfinished one
+        used = {entry['file'] for entry in self.manifest['partitions'].values()} | {self.manifest['totals']}
+        for name in os.listdir(self.path):
+            if REVISION_FILE.match(name) and name not in used:
+                os.remove(os.path.join(self.path, name))
+
+    def append(self, chunk):
+        """
+        Fold a batch of new rentals into the store, returns the numbers of the partitions joined again
+        """
+        rental_id = chunk.rental_id.to_numpy().astype(np.int64)
+        numbers = rental_id // self.partition_size
+        partitions, changed, new_rows = {}, set(), []
+        for number in np.unique(numbers).tolist():
+            partition = partitions[number] = self.load_partition(number)
+            rows = chunk[numbers == number]
+            # The log is append-only, a rental already folded in is not counted twice
+            rows = rows[~np.isin(rows.rental_id.to_numpy().astype(np.int64), partition['records']['rental_id'])]
+            if rows.empty:
+                continue
+            new_records = rental_records(rows)
+            partition['records'] = {
+                column: np.concatenate([values, new_records[column]]) for column, values in partition['records'].items()
+            }
+            new_rows.append(rows)
+            changed.add(number)
+        if not new_rows:
+            return []
+
+        # Folded into the totals in memory, read again from the last revision if this one is not committed
+        try:
+            totals = self.totals()
+            links = totals['aggregates'].update(pd.concat(new_rows))
+            # Chained rentals are kept with their previous rental, which may be in an older partition
+            targets = links['previous_id'] // self.partition_size
+            for number in np.unique(targets).tolist():
+                if number not in partitions:
+                    partitions[number] = self.load_partition(number)
+                partitions[number]['links'] = np.concatenate([partitions[number]['links'], links[targets == number]])
+                changed.add(number)
+
+            # New rentals may be the previous rental of pending links, the chains of these partitions are joined again
+            revision = self.manifest['revision'] + 1
+            manifest = {**self.manifest, 'partitions': dict(self.manifest['partitions'])}
+            for number in sorted(changed):
+                partition = partitions[number]
+                chain = chain_aggregates(partition['links'], partition['records'])
+                totals['chains'][number] = chain
+                manifest['partitions'][str(number)] = {
+                    'file': self.save_partition(number, partition, revision),
+                    'rentals': len(partition['records']['rental_id']),
+                    'chained': len(partition['links']),
+                    'pending': chain['pending_links'],
+                }
+            manifest['totals'] = f'totals-r{revision}.pkl'
+            self._write(manifest['totals'], lambda f: pickle.dump(totals, f), mode='wb')
+
+            # The revision is committed by the manifest naming its files
+            manifest['revision'] = revision
+            self._write('manifest.json', lambda f: json.dump(manifest, f, indent=2))
+            self.manifest = manifest
+        except BaseException:
+            self._totals = None
+            raise
+        self._remove_unused()
+        return sorted(changed)
+
+    def ingest(self, source, chunk_size=CHUNK_SIZE):
+        affected = set()
+        for chunk in read_chunks(source, chunk_size):
+            affected.update(self.append(chunk))
+        if affected:
+            self.save_summary()
+        return sorted(affected)
+
+    def build_summary(self):
+        """
+        Dashboard summary from the merged aggregates and the chain aggregates of the partitions
+        """
+        totals = self.totals()
+        return build_summary(totals['aggregates'], merge_chains(totals['chains'].values()))
+
+    def save_summary(self):
+        # Kept with the revision it summarizes, the manifest is not written
+        summary = self.build_summary()
+        self._write('summary.pkl', lambda f: pickle.dump({'revision': self.manifest['revision'], 'summary': summary}, f), mode='wb')
+        return summary
+
+    def summary(self):
+        """
+        Summary of the revision of the manifest, built in memory if ingest did not save it (read only)
+        """
+        try:
+            saved = self._read_pickle('summary.pkl')
+            if saved['revision'] == self.manifest['revision']:
+                return saved['summary']
+        except (OSError, pickle.UnpicklingError, KeyError, TypeError):
+            pass
+        return self.build_summary()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        sys.exit("Usage: python incremental.py <store_dir> <rentals.parquet|rentals.csv>")
+
+    store = Store(sys.argv[1])
+    affected = store.ingest(sys.argv[2])
+    print(f"Partitions updated: {affected}, store revision {store.manifest['revision']}")
@@ -0,0 +1,123 @@
+# Convert the delay analysis workbook into a typed Parquet file
+#
+# Parsing the xlsx is the slowest part of a dashboard cold start, so it is
+# done once and the result is stored as Parquet with compact dtypes. The
+# file is rebuilt only when the workbook changes (mtime first, then content
+# hash), the hash is also used as the dataset version by the dashboard.
+#
+# Usage: python ingest.py [source.xlsx] [output.parquet]
+
+import hashlib
+import json
+import os
+import sys
+import threading
+
+import pandas as pd
+
+SOURCE = "get_around_delay_analysis.xlsx"
+PARQUET = "get_around_delay_analysis.parquet"
+
+DTYPES = {
+    'rental_id': 'int32',
+    'car_id': 'int32',
+    'checkin_type': pd.CategoricalDtype(['mobile', 'connect']),
+    'state': pd.CategoricalDtype(['ended', 'canceled']),
+    'delay_at_checkout_in_minutes': 'float64',
+    'previous_ended_rental_id': 'float64',
+    'time_delta_with_previous_rental_in_minutes': 'float64',
+}
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def manifest_path(parquet):
+    return parquet + '.json'
+
+
+def read_manifest(parquet):
+    try:
+        with open(manifest_path(parquet)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_atomic(path, write, mode='w'):
+    # Write to a temporary file then rename, readers never see a partial file. The temporary
+    # file is unique, concurrent sessions rebuilding at the same time do not share it.
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, mode) as f:
+            write(f)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def write_manifest(parquet, manifest):
+    write_atomic(manifest_path(parquet), lambda f: json.dump(manifest, f, indent=2))
+
+
+def convert(source=SOURCE, parquet=PARQUET, source_hash=None):
+    """
+    Parse the workbook and write it as a typed Parquet file with its manifest
+    """
+    data = pd.read_excel(source, usecols=list(DTYPES)).astype(DTYPES)
+    # The old manifest is removed first: after a crash a new Parquet file is never paired with the old hash
+    try:
+        os.remove(manifest_path(parquet))
+    except FileNotFoundError:
+        pass
+    write_atomic(parquet, lambda f: data.to_parquet(f, index=False), mode='wb')
+
+    stat = os.stat(source)
+    manifest = {
+        'source': os.path.basename(source),
+        'source_mtime': stat.st_mtime,
+        'source_size': stat.st_size,
+        'source_hash': source_hash or file_hash(source),
+        'rows': len(data),
+    }
+    write_manifest(parquet, manifest)
+    return manifest
+
+
+def ensure_parquet(source=SOURCE, parquet=PARQUET):
+    """
+    Make sure the Parquet file is up to date with the workbook and return its version
+    """
+    manifest = read_manifest(parquet)
+    if manifest is not None and os.path.exists(parquet):
+        stat = os.stat(source)
+        if manifest['source_mtime'] == stat.st_mtime and manifest['source_size'] == stat.st_size:
+            return manifest['source_hash']
+        # Touched but maybe not modified, only the content hash tells
+        source_hash = file_hash(source)
+        if source_hash == manifest['source_hash']:
+            manifest['source_mtime'] = stat.st_mtime
+            write_manifest(parquet, manifest)
+            return source_hash
+        return convert(source, parquet, source_hash)['source_hash']
+    return convert(source, parquet)['source_hash']
+
+
+def load(parquet=PARQUET):
+    """
+    Read the Parquet file memory-mapped, categorical dtypes are kept
+    """
+    return pd.read_parquet(parquet, memory_map=True)
+
+
+if __name__ == "__main__":
+    source = sys.argv[1] if len(sys.argv) > 1 else SOURCE
+    parquet = sys.argv[2] if len(sys.argv) > 2 else PARQUET
+    manifest = convert(source, parquet)
+    print(f"{manifest['rows']} rentals written to {parquet} (version {manifest['source_hash'][:12]})")
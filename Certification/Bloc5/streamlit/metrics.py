@@ -0,0 +1,305 @@
+# Delay analysis metrics
+#
+# Every derived frame or figure of the dashboard is a memoized function of the
+# dataset version (hash of the source workbook, see ingest.py). Upstream
+# results are reached by calling the upstream function with the same version,
+# so everything is computed once per dataset version and shared by all
+# sessions and reruns. Frames are cached as resources (shared, never mutated),
+# small aggregates as data.
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import ingest
+
+LATE_DTYPE = pd.CategoricalDtype(['late', 'in time'])
+DELTA_DTYPE = pd.CategoricalDtype(['< 720 minutes', '> 720 minutes'])
+
+
+def late_column(delay):
+    # 'late' when the checkout delay is positive, 'in time' otherwise (unknown delays included)
+    return pd.Categorical.from_codes(np.where(delay > 0, 0, 1), dtype=LATE_DTYPE)
+
+
+def delta_column(time_delta):
+    # A missing time delta means more than 12 hours with the previous rental
+    return pd.Categorical.from_codes(time_delta.isna().to_numpy().astype(np.int8), dtype=DELTA_DTYPE)
+
+
+def histogram(values, groups, bins):
+    """
+    Counts of values per bin (and per category of groups), as a long dataframe ready for px.bar
+    """
+    values = np.asarray(values, dtype=float)
+    edges = np.histogram_bin_edges(values[~np.isnan(values)], bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    if groups is None:
+        counts, _ = np.histogram(values, bins=edges)
+        return pd.DataFrame({'bin': centers, 'count': counts})
+
+    frames = []
+    for group in groups.cat.categories:
+        counts, _ = np.histogram(values[(groups == group).to_numpy()], bins=edges)
+        frames.append(pd.DataFrame({'bin': centers, groups.name: group, 'count': counts}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def percent_by_group(data, column, group):
+    # Percentage of each value of a column within each group, like histnorm='percent' with a color
+    counts = data.groupby([group, column], observed=True).size()
+    percent = (counts / counts.groupby(level=0).transform('sum') * 100).round(2)
+    return percent.rename('percent').reset_index()
+
+
+def ratio(series, name):
+    # Percentage of each value of a column, as a two columns dataframe
+    return (series.value_counts(normalize=True)*100).rename_axis(name).reset_index(name='counts')
+
+
+# Columns kept from the previous (_x) and the next (_y) rental of a chain
+PREVIOUS_COLUMNS = ['rental_id', 'checkin_type', 'delay_at_checkout_in_minutes', 'late']
+NEXT_COLUMNS = ['rental_id', 'checkin_type', 'state', 'time_delta_with_previous_rental_in_minutes']
+
+
+@st.cache_resource(show_spinner=False)
+def dataset(version):
+    data = ingest.load()
+    # Create new column to show if a car is late or not
+    data['late'] = late_column(data['delay_at_checkout_in_minutes'])
+    return data
+
+
+@st.cache_data(show_spinner=False)
+def quick_figures(version):
+    data = dataset(version)
+    return {
+        # Number of unique cars and rentals
+        'cars': data['car_id'].nunique(),
+        'rentals': data['rental_id'].nunique(),
+        # Mean delay at checkout in minutes, global and by checkin type
+        'global_delay_mean': data.delay_at_checkout_in_minutes.mean(),
+        'delay_mobile_type': data[data.checkin_type == 'mobile'].delay_at_checkout_in_minutes.mean(),
+        'delay_connect_type': data[data.checkin_type == 'connect'].delay_at_checkout_in_minutes.mean(),
+        # Numbers of effective and canceled rentals
+        'effective_rentals': len(data_clean(version)),
+        'canceled_rentals': len(data_canceled(version)),
+    }
+
+
+@st.cache_resource(show_spinner=False)
+def data_without_outliers(version):
+    # Rentals with a delay at checkout between 12 hours
+    data = dataset(version)
+    return data[(data.delay_at_checkout_in_minutes > -720) & (data.delay_at_checkout_in_minutes < 720)]
+
+
+@st.cache_data(show_spinner=False)
+def delay_histogram(version, bin_width=20):
+    # Delay at checkout distribution within 12 hours range by checkin type
+    data = data_without_outliers(version)
+    return histogram(data.delay_at_checkout_in_minutes, data.checkin_type, np.arange(-720, 720 + bin_width, bin_width))
+
+
+@st.cache_data(show_spinner=False)
+def ratio_checkin_type(version):
+    return ratio(dataset(version)['checkin_type'], 'state')
+
+
+@st.cache_resource(show_spinner=False)
+def data_clean(version):
+    # Rentals with a known delay at checkout
+    data = dataset(version)
+    return data[data["delay_at_checkout_in_minutes"].notna()]
+
+
+@st.cache_data(show_spinner=False)
+def late_ratio(version):
+    return ratio(data_clean(version)['late'], 'late')
+
+
+@st.cache_data(show_spinner=False)
+def late_by_checkin(version):
+    return percent_by_group(data_clean(version), 'late', 'checkin_type')
+
+
+@st.cache_data(show_spinner=False)
+def state_ratio(version):
+    return ratio(dataset(version)['state'], 'state')
+
+
+@st.cache_data(show_spinner=False)
+def state_by_checkin(version):
+    return percent_by_group(dataset(version), 'state', 'checkin_type')
+
+
+@st.cache_resource(show_spinner=False)
+def data_canceled(version):
+    data = dataset(version)
+    data_canceled = data[data["state"] == "canceled"].copy()
+    # Create column telling if the previous rental is more than 12 hours before
+    data_canceled['delta'] = delta_column(data_canceled.time_delta_with_previous_rental_in_minutes)
+    return data_canceled
+
+
+@st.cache_data(show_spinner=False)
+def canceled_delta_ratio_all(version):
+    # Ratio delta for canceled rentals
+    return ratio(data_canceled(version).delta, 'delta')
+
+
+@st.cache_data(show_spinner=False)
+def canceled_delta_ratio(version):
+    # Ratio delta for canceled rentals with only < 12h delta time
+    return ratio(data_canceled(version).time_delta_with_previous_rental_in_minutes, 'delta')
+
+
+@st.cache_resource(show_spinner=False)
+def rental_chain(version):
+    """
+    Every (previous, next) pair of chained rentals, built once.
+
+    The position of each previous rental is found with a single lookup of
+    previous_ended_rental_id in the rental_id index, then only the needed
+    columns of both rentals are gathered by position.
+    """
+    data = dataset(version)
+    previous_position = pd.Index(data['rental_id']).get_indexer(data['previous_ended_rental_id'])
+    # -1 when there is no previous rental or when it is not in the dataset
+    next_position = np.flatnonzero(previous_position >= 0)
+    previous_position = previous_position[next_position]
+
+    pairs = {'position_x': previous_position}
+    for column in PREVIOUS_COLUMNS:
+        pairs[f'{column}_x'] = data[column].iloc[previous_position].reset_index(drop=True)
+    for column in NEXT_COLUMNS:
+        pairs[f'{column}_y'] = data[column].iloc[next_position].reset_index(drop=True)
+    return pd.DataFrame(pairs)
+
+
+@st.cache_resource(show_spinner=False)
+def canceled_merged(version):
+    # Previous rentals of the canceled rentals with all their next rentals
+    chain = rental_chain(version)
+    previous_position = chain['position_x'].to_numpy()
+    canceled = (chain['state_y'] == 'canceled').to_numpy()
+    # Flag by position the previous rentals having a canceled next rental
+    previous_of_canceled = np.zeros(len(dataset(version)), dtype=bool)
+    previous_of_canceled[previous_position[canceled]] = True
+    return chain[previous_of_canceled[previous_position]]
+
+
+@st.cache_data(show_spinner=False)
+def canceled_checkin_ratio(version):
+    # Ratio of checkin type for cancelation
+    return ratio(canceled_merged(version)['checkin_type_x'], 'checkin')
+
+
+@st.cache_data(show_spinner=False)
+def canceled_lateness_ratio(version):
+    # Ratio of lateness for cancelation
+    return ratio(canceled_merged(version)['late_x'], 'lateness')
+
+
+@st.cache_resource(show_spinner=False)
+def data_canceled_late(version):
+    # Only late previous rentals
+    merged_data = canceled_merged(version)
+    return merged_data[merged_data.delay_at_checkout_in_minutes_x > 0]
+
+
+@st.cache_data(show_spinner=False)
+def canceled_late_histogram(version, bins=250):
+    # Delay at checkout of the late previous rentals of canceled rentals
+    return histogram(data_canceled_late(version).delay_at_checkout_in_minutes_x, None, bins)
+
+
+@st.cache_data(show_spinner=False)
+def threshold_delay(version):
+    return data_canceled_late(version).delay_at_checkout_in_minutes_x.quantile(0.75)
+
+
+@st.cache_resource(show_spinner=False)
+def ended_merged(version):
+    # Chained rentals where the next rental ended
+    chain = rental_chain(version)
+    return chain[chain["state_y"] == "ended"]
+
+
+@st.cache_data(show_spinner=False)
+def rentals_affected(version):
+    # Number of ended rentals that the threshold would have prevented
+    data_merged_ended = ended_merged(version)
+    data_ended_treshold = data_merged_ended[data_merged_ended["time_delta_with_previous_rental_in_minutes_y"] >= threshold_delay(version)]
+    return len(data_merged_ended) - len(data_ended_treshold)
+
+
+# Scopes of the threshold, every checkin type or only the connect one
+SCOPES = ['all', 'connect']
+
+
+def cumulative_counts(values):
+    # Sorted distinct values and how many values are below each of them (the last one is the total)
+    values, counts = np.unique(values, return_counts=True)
+    return values, np.concatenate([[0], np.cumsum(counts)])
+
+
+def count_below(cumulative, thresholds):
+    # Number of values strictly below each threshold, a binary search in the distinct values
+    values, below = cumulative
+    return below[np.searchsorted(values, thresholds, side='left')]
+
+
+@st.cache_resource(show_spinner=False)
+def threshold_arrays(version):
+    """
+    Cumulative counts of time deltas per scope for the threshold simulator.
+
+    For a threshold t, the ended rentals booked less than t minutes after the
+    previous one are affected, and the problem cases (previous rental returned
+    later than the time delta) within less than t minutes are solved. Both are
+    a searchsorted of t in these arrays.
+    """
+    data = dataset(version)
+    chain = rental_chain(version)
+    problem = chain[chain.delay_at_checkout_in_minutes_x > chain.time_delta_with_previous_rental_in_minutes_y]
+    ended = ended_merged(version)
+
+    arrays = {}
+    for scope in SCOPES:
+        scope_ended, scope_problem = ended, problem
+        if scope != 'all':
+            scope_ended = ended[ended.checkin_type_y == scope]
+            scope_problem = problem[problem.checkin_type_y == scope]
+        arrays[scope] = {
+            'affected': cumulative_counts(scope_ended.time_delta_with_previous_rental_in_minutes_y.to_numpy()),
+            'solved': cumulative_counts(scope_problem.time_delta_with_previous_rental_in_minutes_y.to_numpy()),
+            'rentals': len(data) if scope == 'all' else int((data.checkin_type == scope).sum()),
+        }
+    return arrays
+
+
+def threshold_effect(arrays, scope, threshold):
+    # Rentals affected and problem cases solved for one threshold, O(log n)
+    scope_arrays = arrays[scope]
+    return {
+        'affected': int(count_below(scope_arrays['affected'], threshold)),
+        'solved': int(count_below(scope_arrays['solved'], threshold)),
+        'problems': int(scope_arrays['solved'][1][-1]),
+        'rentals': scope_arrays['rentals'],
+    }
+
+
+def curves(scope_arrays, step=10, maximum=720):
+    # Rentals affected and problem cases solved for every threshold of the slider
+    thresholds = np.arange(0, maximum + step, step)
+    return {
+        'thresholds': thresholds,
+        'affected': count_below(scope_arrays['affected'], thresholds),
+        'solved': count_below(scope_arrays['solved'], thresholds),
+    }
+
+
+@st.cache_data(show_spinner=False)
+def threshold_curves(version, scope):
+    return curves(threshold_arrays(version)[scope])
@@ -0,0 +1,472 @@
+# Out-of-core delay analysis
+#
+# Same figures as metrics.py, computed by reading the rental log by chunks
+# (Parquet row batches or CSV chunks) and keeping incremental aggregates only:
+# counts, sums, fixed bin histograms and quantile sketches. The full table is
+# never built. Chained rentals need their previous rental: the first pass
+# spills the chained rentals (booked less than 12 hours after the previous
+# one) to a temporary directory, the second pass spills the compact columns of
+# every rental, both split in buckets of rental id. Each bucket then joins its
+# chained rentals with their previous rental on its own, so memory holds one
+# chunk or one bucket, whatever the length of the log.
+#
+# The dashboard uses this module instead of metrics.py when the
+# DELAY_ANALYSIS_MODE environment variable is set to 'streaming'. The source
+# can also be an incremental store directory (see incremental.py).
+
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import ingest
+# Threshold helpers work the same on both sides
+from metrics import SCOPES, LATE_DTYPE, DELTA_DTYPE, late_column, threshold_effect, curves
+
+CHUNK_SIZE = 100_000
+# Parquet or CSV rental log or incremental store, defaults to the converted workbook
+SOURCE = os.environ.get('DELAY_ANALYSIS_SOURCE', ingest.PARQUET)
+
+CHECKIN_TYPES = list(ingest.DTYPES['checkin_type'].categories)
+STATES = list(ingest.DTYPES['state'].categories)
+CANCELED = STATES.index('canceled')
+ENDED = STATES.index('ended')
+# Same bins as metrics.delay_histogram
+DELAY_EDGES = np.arange(-720, 720 + 20, 20)
+# Rentals per bucket of the chained rentals join
+BUCKET_ROWS = 200_000
+
+# Spilled rows: a chained rental and the rental it follows, a rental that may be followed
+LINK_DTYPE = np.dtype([('previous_id', np.int64), ('state', np.int64), ('checkin', np.int64), ('time_delta', float)])
+RECORD_DTYPE = np.dtype([('rental_id', np.int64), ('delay', float), ('checkin', np.int64)])
+
+
+def read_chunks(source=SOURCE, chunk_size=CHUNK_SIZE):
+    """
+    Yield typed chunks of the rental log, from a Parquet or a CSV file
+    """
+    columns = list(ingest.DTYPES)
+    if source.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas().astype(ingest.DTYPES)
+    else:
+        yield from pd.read_csv(source, usecols=columns, dtype=ingest.DTYPES, chunksize=chunk_size)
+
+
+def bincount_2d(rows, columns, shape):
+    # Counts of every (row, column) pair of codes
+    counts = np.bincount(rows * shape[1] + columns, minlength=shape[0] * shape[1])
+    return counts.reshape(shape)
+
+
+class QuantileSketch:
+    """
+    Mergeable counts of values rounded to a resolution.
+
+    Delays and time deltas are whole minutes, so with the default resolution
+    the sketch is exact: quantiles interpolate like pandas and histograms
+    match np.histogram. Its size depends on the range of the values, not on
+    the number of rentals.
+    """
+
+    def __init__(self, resolution=1.0):
+        self.resolution = resolution
+        self.counts = {}
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        keys, counts = np.unique(np.round(values / self.resolution).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def values_counts(self):
+        keys = sorted(self.counts)
+        counts = np.array([self.counts[key] for key in keys], dtype=np.int64)
+        return np.array(keys, dtype=float) * self.resolution, counts
+
+    def quantile(self, q):
+        values, counts = self.values_counts()
+        if not len(values):
+            return np.nan
+        # Linear interpolation between the two closest ranks, like pandas
+        cumulative = np.cumsum(counts)
+        position = q * (cumulative[-1] - 1)
+        lower = values[np.searchsorted(cumulative, np.floor(position), side='right')]
+        upper = values[np.searchsorted(cumulative, np.ceil(position), side='right')]
+        return lower + (upper - lower) * (position - np.floor(position))
+
+    def cumulative(self):
+        # Same layout as metrics.cumulative_counts
+        values, counts = self.values_counts()
+        return values, np.concatenate([[0], np.cumsum(counts)])
+
+    def histogram(self, bins):
+        values, counts = self.values_counts()
+        edges = np.histogram_bin_edges(values, bins=bins)
+        histogram, _ = np.histogram(values, bins=edges, weights=counts)
+        return histogram.astype(np.int64), edges
+
+
+class DelayAggregates:
+    """
+    Incremental aggregates of the rental log, updated chunk by chunk and mergeable.
+
+    Their size does not depend on the number of rentals, the chained rentals
+    of each chunk are returned by update() for the caller to keep or spill.
+    """
+
+    def __init__(self):
+        checkins, states, lates = len(CHECKIN_TYPES), len(STATES), len(LATE_DTYPE.categories)
+        self.rentals = 0
+        self.car_ids = np.empty(0, dtype=np.int64)
+        self.state_by_checkin = np.zeros((checkins, states), dtype=np.int64)
+        # Only rentals with a known delay at checkout
+        self.late_by_checkin = np.zeros((checkins, lates), dtype=np.int64)
+        self.delay_sum = np.zeros(checkins)
+        self.delay_histogram = np.zeros((checkins, len(DELAY_EDGES) - 1), dtype=np.int64)
+        self.canceled_delta = np.zeros(len(DELTA_DTYPE.categories), dtype=np.int64)
+        self.canceled_time_delta = QuantileSketch()
+
+    def update(self, chunk):
+        """
+        Fold a chunk in, returns its chained rentals (LINK_DTYPE rows)
+        """
+        checkin = chunk.checkin_type.cat.codes.to_numpy().astype(np.int64)
+        state = chunk.state.cat.codes.to_numpy().astype(np.int64)
+        delay = chunk.delay_at_checkout_in_minutes.to_numpy()
+        time_delta = chunk.time_delta_with_previous_rental_in_minutes.to_numpy()
+        clean = ~np.isnan(delay)
+
+        self.rentals += len(chunk)
+        self.car_ids = np.union1d(self.car_ids, chunk.car_id.to_numpy().astype(np.int64))
+        self.state_by_checkin += bincount_2d(checkin, state, self.state_by_checkin.shape)
+        late = late_column(delay).codes.astype(np.int64)
+        self.late_by_checkin += bincount_2d(checkin[clean], late[clean], self.late_by_checkin.shape)
+        self.delay_sum += np.bincount(checkin[clean], weights=delay[clean], minlength=len(CHECKIN_TYPES))
+
+        in_range = clean & (delay > -720) & (delay < 720)
+        for code in range(len(CHECKIN_TYPES)):
+            self.delay_histogram[code] += np.histogram(delay[in_range & (checkin == code)], bins=DELAY_EDGES)[0]
+
+        canceled = state == CANCELED
+        self.canceled_delta += np.bincount(np.isnan(time_delta[canceled]).astype(np.int64), minlength=len(self.canceled_delta))
+        self.canceled_time_delta.update(time_delta[canceled])
+
+        previous_id = chunk.previous_ended_rental_id.to_numpy()
+        chained = ~np.isnan(previous_id)
+        links = np.empty(int(chained.sum()), dtype=LINK_DTYPE)
+        links['previous_id'] = previous_id[chained]
+        links['state'] = state[chained]
+        links['checkin'] = checkin[chained]
+        links['time_delta'] = time_delta[chained]
+        return links
+
+    def merge(self, other):
+        self.rentals += other.rentals
+        self.car_ids = np.union1d(self.car_ids, other.car_ids)
+        self.state_by_checkin += other.state_by_checkin
+        self.late_by_checkin += other.late_by_checkin
+        self.delay_sum += other.delay_sum
+        self.delay_histogram += other.delay_histogram
+        self.canceled_delta += other.canceled_delta
+        self.canceled_time_delta.merge(other.canceled_time_delta)
+
+
+def rental_records(chunk):
+    # Compact columns of a chunk needed when its rentals are the previous rental of another one
+    return {
+        'rental_id': chunk.rental_id.to_numpy().astype(np.int64),
+        'delay': chunk.delay_at_checkout_in_minutes.to_numpy(),
+        'checkin': chunk.checkin_type.cat.codes.to_numpy().astype(np.int64),
+    }
+
+
+def record_rows(records):
+    # rental_records as RECORD_DTYPE rows, the layout of the spilled rentals
+    rows = np.empty(len(records['rental_id']), dtype=RECORD_DTYPE)
+    for column, values in records.items():
+        rows[column] = values
+    return rows
+
+
+def chain_aggregates(links, previous):
+    """
+    Aggregates of the (previous, next) rental pairs, the same ones metrics.rental_chain serves
+    """
+    # Positional join of every link with its previous rental
+    order = np.argsort(previous['rental_id'], kind='stable')
+    sorted_ids = previous['rental_id'][order]
+    position = np.searchsorted(sorted_ids, links['previous_id'])
+    found = position < len(sorted_ids)
+    found[found] = sorted_ids[position[found]] == links['previous_id'][found]
+    position = order[position[found]]
+
+    previous_id = links['previous_id'][found]
+    state_y = links['state'][found].astype(np.int64)
+    checkin_y = links['checkin'][found].astype(np.int64)
+    time_delta_y = links['time_delta'][found]
+    delay_x = previous['delay'][position]
+    checkin_x = previous['checkin'][position].astype(np.int64)
+
+    # Previous rentals of the canceled rentals with all their next rentals
+    canceled = np.isin(previous_id, np.unique(previous_id[state_y == CANCELED]))
+    canceled_late = QuantileSketch()
+    canceled_late.update(delay_x[canceled & (delay_x > 0)])
+
+    ended = state_y == ENDED
+    problem = delay_x > time_delta_y
+    ended_time_delta, problem_time_delta = {}, {}
+    for scope in SCOPES:
+        in_scope = np.ones(len(state_y), dtype=bool) if scope == 'all' else checkin_y == CHECKIN_TYPES.index(scope)
+        ended_time_delta[scope] = QuantileSketch()
+        ended_time_delta[scope].update(time_delta_y[ended & in_scope])
+        problem_time_delta[scope] = QuantileSketch()
+        problem_time_delta[scope].update(time_delta_y[problem & in_scope])
+
+    return {
+        # Chained rentals whose previous rental is not known yet
+        'pending_links': int(len(found) - found.sum()),
+        'canceled_checkin': np.bincount(checkin_x[canceled], minlength=len(CHECKIN_TYPES)),
+        'canceled_late': np.bincount(late_column(delay_x[canceled]).codes.astype(np.int64), minlength=len(LATE_DTYPE.categories)),
+        'canceled_late_delay': canceled_late,
+        'ended_time_delta': ended_time_delta,
+        'problem_time_delta': problem_time_delta,
+    }
+
+
+def merge_chains(chains):
+    """
+    Sum of chain_aggregates computed on disjoint groups of previous rentals
+    """
+    # Summed into an empty one, the chains given are left unchanged
+    total = chain_aggregates(np.empty(0, dtype=LINK_DTYPE), np.empty(0, dtype=RECORD_DTYPE))
+    for chain in chains:
+        total['pending_links'] += chain['pending_links']
+        total['canceled_checkin'] = total['canceled_checkin'] + chain['canceled_checkin']
+        total['canceled_late'] = total['canceled_late'] + chain['canceled_late']
+        total['canceled_late_delay'].merge(chain['canceled_late_delay'])
+        for scope in SCOPES:
+            total['ended_time_delta'][scope].merge(chain['ended_time_delta'][scope])
+            total['problem_time_delta'][scope].merge(chain['problem_time_delta'][scope])
+    return total
+
+
+class BucketSpill:
+    """
+    Rows appended to files on disk, split in buckets of a key column.
+
+    Chained rentals go to the bucket of their previous rental id and rentals
+    to the bucket of their own id: every chained rental of a previous rental
+    and that rental end up in the same bucket, joined alone.
+    """
+
+    def __init__(self, directory, buckets):
+        self.directory = directory
+        self.buckets = buckets
+
+    def _path(self, name, bucket):
+        return os.path.join(self.directory, f'{name}-{bucket}.bin')
+
+    def append(self, name, rows, key):
+        bucket_of = rows[key] % self.buckets
+        for bucket in np.unique(bucket_of).tolist():
+            with open(self._path(name, bucket), 'ab') as f:
+                rows[bucket_of == bucket].tofile(f)
+
+    def read(self, name, bucket, dtype):
+        path = self._path(name, bucket)
+        return np.fromfile(path, dtype=dtype) if os.path.exists(path) else np.empty(0, dtype=dtype)
+
+
+def read_spilled(path, dtype, block_rows=CHUNK_SIZE):
+    # Rows of a spill file, block by block
+    with open(path, 'rb') as f:
+        while True:
+            rows = np.fromfile(f, dtype=dtype, count=block_rows)
+            if not len(rows):
+                return
+            yield rows
+
+
+def ratio_from_counts(counts, name):
+    # Same frame as metrics.ratio, from counts instead of the rows
+    counts = counts.sort_values(ascending=False, kind='stable')
+    return (counts / counts.sum() * 100).rename_axis(name).reset_index(name='counts')
+
+
+def percent_from_counts(counts, group, column):
+    # Same frame as metrics.percent_by_group, from a (group x column) counts frame
+    counts = counts.stack()
+    counts = counts[counts > 0]
+    percent = (counts / counts.groupby(level=0).transform('sum') * 100).round(2)
+    return percent.rename('percent').rename_axis([group, column]).reset_index()
+
+
+def build_summary(aggregates, chain):
+    """
+    Every figure of the dashboard, in the layout returned by metrics.py
+    """
+    late_categories = list(LATE_DTYPE.categories)
+    state_by_checkin = pd.DataFrame(aggregates.state_by_checkin, index=CHECKIN_TYPES, columns=STATES)
+    late_by_checkin = pd.DataFrame(aggregates.late_by_checkin, index=CHECKIN_TYPES, columns=late_categories)
+    checkin_counts = state_by_checkin.sum(axis=1)
+    delay_count = late_by_checkin.sum(axis=1)
+    delay_mean = aggregates.delay_sum / delay_count.to_numpy()
+
+    centers = (DELAY_EDGES[:-1] + DELAY_EDGES[1:]) / 2
+    delay_histogram = pd.concat([
+        pd.DataFrame({'bin': centers, 'checkin_type': checkin, 'count': aggregates.delay_histogram[code]})
+        for code, checkin in enumerate(CHECKIN_TYPES)
+    ], ignore_index=True)
+
+    values, counts = aggregates.canceled_time_delta.values_counts()
+    canceled_late_counts, edges = chain['canceled_late_delay'].histogram(250)
+
+    return {
+        'quick_figures': {
+            'cars': len(aggregates.car_ids),
+            'rentals': aggregates.rentals,
+            'global_delay_mean': aggregates.delay_sum.sum() / delay_count.sum(),
+            'delay_mobile_type': delay_mean[CHECKIN_TYPES.index('mobile')],
+            'delay_connect_type': delay_mean[CHECKIN_TYPES.index('connect')],
+            'effective_rentals': int(delay_count.sum()),
+            'canceled_rentals': int(state_by_checkin['canceled'].sum()),
+        },
+        'delay_histogram': delay_histogram,
+        'ratio_checkin_type': ratio_from_counts(checkin_counts, 'state'),
+        'late_ratio': ratio_from_counts(late_by_checkin.sum(axis=0), 'late'),
+        'late_by_checkin': percent_from_counts(late_by_checkin, 'checkin_type', 'late'),
+        'state_ratio': ratio_from_counts(state_by_checkin.sum(axis=0), 'state'),
+        'state_by_checkin': percent_from_counts(state_by_checkin, 'checkin_type', 'state'),
+        'canceled_delta_ratio_all': ratio_from_counts(pd.Series(aggregates.canceled_delta, index=list(DELTA_DTYPE.categories)), 'delta'),
+        'canceled_delta_ratio': ratio_from_counts(pd.Series(counts, index=values), 'delta'),
+        'canceled_checkin_ratio': ratio_from_counts(pd.Series(chain['canceled_checkin'], index=CHECKIN_TYPES), 'checkin'),
+        'canceled_lateness_ratio': ratio_from_counts(pd.Series(chain['canceled_late'], index=late_categories), 'lateness'),
+        'canceled_late_histogram': pd.DataFrame({'bin': (edges[:-1] + edges[1:]) / 2, 'count': canceled_late_counts}),
+        'threshold_delay': chain['canceled_late_delay'].quantile(0.75),
+        'pending_links': chain['pending_links'],
+        'threshold_arrays': {
+            scope: {
+                'affected': chain['ended_time_delta'][scope].cumulative(),
+                'solved': chain['problem_time_delta'][scope].cumulative(),
+                'rentals': aggregates.rentals if scope == 'all' else int(checkin_counts[scope]),
+            }
+            for scope in SCOPES
+        },
+    }
+
+
+def aggregate(source=SOURCE, chunk_size=CHUNK_SIZE, bucket_rows=BUCKET_ROWS):
+    """
+    Two passes over the rental log, memory only holds one chunk or one bucket and the aggregates
+    """
+    aggregates = DelayAggregates()
+    with tempfile.TemporaryDirectory(prefix='delay-analysis-') as directory:
+        links_path = os.path.join(directory, 'links.bin')
+        with open(links_path, 'wb') as f:
+            for chunk in read_chunks(source, chunk_size):
+                aggregates.update(chunk).tofile(f)
+
+        # Enough buckets for each one to hold about bucket_rows rentals
+        spill = BucketSpill(directory, max(1, -(-aggregates.rentals // bucket_rows)))
+        for links in read_spilled(links_path, LINK_DTYPE):
+            spill.append('links', links, 'previous_id')
+        os.remove(links_path)
+        for chunk in read_chunks(source, chunk_size):
+            spill.append('records', record_rows(rental_records(chunk)), 'rental_id')
+
+        chain = merge_chains(
+            chain_aggregates(spill.read('links', bucket, LINK_DTYPE), spill.read('records', bucket, RECORD_DTYPE))
+            for bucket in range(spill.buckets)
+        )
+    return build_summary(aggregates, chain)
+
+
+def source_version(source=SOURCE):
+    # The converted workbook has a content version, other sources are versioned by mtime and size
+    if os.path.isdir(source):
+        import incremental
+        return incremental.Store(source).version()
+    if source == ingest.PARQUET:
+        return ingest.ensure_parquet()
+    stat = os.stat(source)
+    return f'{os.path.basename(source)}-{stat.st_mtime_ns}-{stat.st_size}'
+
+
+@st.cache_resource(show_spinner=False)
+def summary(version):
+    if os.path.isdir(SOURCE):
+        # Partition summaries already folded in, only merged here
+        import incremental
+        return incremental.Store(SOURCE).summary()
+    return aggregate()
+
+
+# Same functions as metrics.py, served from the summary
+
+def quick_figures(version):
+    return summary(version)['quick_figures']
+
+
+def delay_histogram(version):
+    return summary(version)['delay_histogram']
+
+
+def ratio_checkin_type(version):
+    return summary(version)['ratio_checkin_type']
+
+
+def late_ratio(version):
+    return summary(version)['late_ratio']
+
+
+def late_by_checkin(version):
+    return summary(version)['late_by_checkin']
+
+
+def state_ratio(version):
+    return summary(version)['state_ratio']
+
+
+def state_by_checkin(version):
+    return summary(version)['state_by_checkin']
+
+
+def canceled_delta_ratio_all(version):
+    return summary(version)['canceled_delta_ratio_all']
+
+
+def canceled_delta_ratio(version):
+    return summary(version)['canceled_delta_ratio']
+
+
+def canceled_checkin_ratio(version):
+    return summary(version)['canceled_checkin_ratio']
+
+
+def canceled_lateness_ratio(version):
+    return summary(version)['canceled_lateness_ratio']
+
+
+def canceled_late_histogram(version):
+    return summary(version)['canceled_late_histogram']
+
+
+def threshold_delay(version):
+    return summary(version)['threshold_delay']
+
+
+def threshold_arrays(version):
+    return summary(version)['threshold_arrays']
+
+
+def threshold_curves(version, scope):
+    return curves(threshold_arrays(version)[scope])
@@ -34,16 +34,45 @@ with col1:
 
   # with st.form("Select your theme"):
     choice = st.selectbox('Pick one', melody)
-    input_midi_data, theme = model.create_input(choice)
+    # Smooth: the music moves between close sequences, contrasting: between distant ones
+    mode = st.radio('Transition', ['Random', 'Smooth', 'Contrasting'], horizontal=True)
+    input_samples, theme = model.create_input(choice)
+    # Start building the model of this theme while the user gets ready to click
+    model.models.warm([model.model_name(theme)])
+    # And keep a few tracks of this theme and transition ready
+    model.pool.start((choice, mode.lower()))
     generate = st.button("Generate")
 
 with col2:
 
     if generate:
-        with st.spinner("Generating..."):
-          extracted_16= model.gen_interpolation(input_midi_data,theme)
-          g_16bar_mean,  interp_model= model.gen_final(extracted_16,theme)
-
+        # A track generated in the background plays at once, otherwise it is generated now
+        audio = model.pop_track(choice, mode.lower())
+        if audio is None:
+          with st.spinner("Generating..."):
+            try:
+              g_16bar_mean,  interp_model= model.gen_from_latents(theme, input_samples, mode.lower())
+              audio = model.sequence_to_wav_file(g_16bar_mean, theme)
+            except model.EndpointError as e:
+              st.error(f"These samples cannot be interpolated ({e}), click Generate to try other ones.")
+
+        if audio is not None:
           st.text("play your song")
-          wav_file = model.sequence_to_wav_file(g_16bar_mean, theme) 
-          st.audio(wav_file, format='wav') 
\ No newline at end of file
+          st.audio(audio, format='wav')
+
+with st.expander("Models"):
+    for name, status in model.models.status().items():
+        if status['loaded']:
+            st.text(f"{name}: loaded from {status['source']} in {status['load_time']:.1f} s")
+        elif status['error']:
+            st.text(f"{name}: {status['error']}")
+        else:
+            st.text(f"{name}: {'loading' if status['loading'] else 'loaded on first use'}") 
+
+with st.expander("Pool"):
+    for (pool_choice, pool_mode), stats in sorted(model.pool.stats().items()):
+        hit_rate = f"{stats['hit_rate']:.0%}" if stats['hit_rate'] is not None else '-'
+        st.text(f"{pool_choice} {pool_mode}: {stats['ready']} ready, {stats['generating']} generating, "
+                f"{stats['hits']} hits, {stats['misses']} misses ({hit_rate} hit rate), {stats['expired']} expired")
+        if stats['error']:
+            st.text(f"  last error: {stats['error']}")
@@ -0,0 +1,54 @@
+"""Throughput of the interpolation decoding, one track at a time or in batches.
+
+For each model batch size, the same tracks (random endpoints among the stored
+latent vectors of a theme, one temperature) are decoded one request per call
+as the app did, then all in one decode_interpolations call. Rendering is left
+out, only the decoder runs.
+
+Usage: python bench_batch.py [theme] [tracks] [batch_size ...]
+  python bench_batch.py sad 16 4 8 16
+"""
+
+import random
+import sys
+import time
+
+from corpus import THEMES
+from latents import LatentStore, batch_fill, decode_interpolations
+from model_manager import ModelManager
+
+NUM_STEPS = 3
+LENGTH = 256
+TEMPERATURE = 0.5
+
+
+def tracks_per_second(model, requests, batched):
+  start_time = time.perf_counter()
+  if batched:
+    decode_interpolations(model, requests, NUM_STEPS, LENGTH)
+  else:
+    for request in requests:
+      decode_interpolations(model, [request], NUM_STEPS, LENGTH)
+  return len(requests) / (time.perf_counter() - start_time)
+
+
+if __name__ == '__main__':
+  theme = sys.argv[1] if len(sys.argv) > 1 else 'sad'
+  tracks = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+  batch_sizes = [int(size) for size in sys.argv[3:]] or [4, 8, 16]
+
+  store = LatentStore()
+  index = None
+  for batch_size in batch_sizes:
+    # A graph is built for each batch size
+    model = ModelManager(batch_size=batch_size).get(THEMES[theme])
+    index = index or store.index(theme, lambda: model)
+    rows = index.rows()
+    requests = [(index.z[random.choice(rows)], index.z[random.choice(rows)], TEMPERATURE) for _ in range(tracks)]
+    # The first run of a graph is slower, it is not timed
+    decode_interpolations(model, requests[:1], NUM_STEPS, LENGTH)
+
+    one_by_one = tracks_per_second(model, requests, batched=False)
+    batched = tracks_per_second(model, requests, batched=True)
+    print(f"batch size {batch_size:3}  one by one {one_by_one:6.2f} tracks/s (fill {batch_fill(requests[:1], NUM_STEPS, batch_size):4.0%})  "
+          f"batched {batched:6.2f} tracks/s (fill {batch_fill(requests, NUM_STEPS, batch_size):4.0%})  x{batched / one_by_one:.1f}")
@@ -0,0 +1,177 @@
+"""Precomputed corpus of the 16-bar melodies and trios of the MIDI samples.
+
+The sliding-window extraction of every sample file is done once, offline,
+and the extracted NoteSequences are stored serialized in one file per theme
+(corpus/<theme>.pkl), grouped by source file. The manifest keeps the sha256,
+size and mtime of each source file: a change is detected from the size and
+mtime only, the files whose size or mtime changed are hashed again and a
+rebuild only extracts the files whose content changed and drops the removed
+ones. The app loads a theme once and samples from memory. A theme is built
+and loaded under its lock, shared with its latent vectors (latents.py), so
+the pool workers and the app never build it twice at once.
+
+Usage: python corpus.py [theme ...]   # build or update the index, every theme by default
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import sys
+import threading
+
+from model_manager import config
+
+SAMPLES_DIR = 'midi_samples'
+CORPUS_DIR = os.environ.get('MUSICVAE_CORPUS_DIR', 'corpus')
+MANIFEST = 'manifest.json'
+
+# Sad themes are melodies, dance themes are trios
+THEMES = {
+  'sad': 'hierdec_mel_16bar',
+  'dance': 'hierdec_trio_16bar',
+}
+
+
+def sample_files(theme):
+  directory = os.path.join(SAMPLES_DIR, theme)
+  return sorted(name for name in os.listdir(directory) if not name.startswith('.'))
+
+
+def source_stats(theme):
+  stats = {}
+  for name in sample_files(theme):
+    stat = os.stat(os.path.join(SAMPLES_DIR, theme, name))
+    stats[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+  return stats
+
+
+def source_hash(theme, name):
+  with open(os.path.join(SAMPLES_DIR, theme, name), 'rb') as f:
+    return hashlib.sha256(f.read()).hexdigest()
+
+
+def extract(midi_data, theme):
+  """All unique 16-bar melodies or trios of a MIDI file, using a sliding window with a stride of 1 bar."""
+  import note_seq
+
+  data_converter = config(THEMES[theme]).data_converter
+  sequence = note_seq.midi_to_note_sequence(midi_data)
+  return data_converter.from_tensors(data_converter.to_tensors(sequence)[1])
+
+
+class Corpus:
+
+  def __init__(self, directory=CORPUS_DIR):
+    self.directory = directory
+    # Deserialized sequences by theme and source file, kept for the life of the process
+    self.sequences = {}
+    # Lock of each theme, this one guards them and the shared manifest
+    self._locks = {}
+    self._locks_lock = threading.Lock()
+
+  def lock(self, theme):
+    """Lock held while a theme is built or loaded, reentrant."""
+    with self._locks_lock:
+      if theme not in self._locks:
+        self._locks[theme] = threading.RLock()
+      return self._locks[theme]
+
+  def manifest(self):
+    try:
+      with open(os.path.join(self.directory, MANIFEST)) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return {}
+
+  def _path(self, theme):
+    return os.path.join(self.directory, theme + '.pkl')
+
+  def _write(self, path, write, mode='w'):
+    with open(path + '.tmp', mode) as f:
+      write(f)
+    os.replace(path + '.tmp', path)
+
+  def _read_theme(self, theme):
+    try:
+      with open(self._path(theme), 'rb') as f:
+        return pickle.load(f)
+    except OSError:
+      return {}
+
+  def stale(self, theme):
+    # True when sample files were added, removed or had their size or mtime changed since the last build
+    known = {
+      name: {'size': entry.get('size'), 'mtime_ns': entry.get('mtime_ns')}
+      for name, entry in self.manifest().get(theme, {}).items()
+    }
+    return known != source_stats(theme)
+
+  def build(self, theme):
+    """Extract the files added or changed since the last build, returns their names."""
+    with self.lock(theme):
+      return self._build(theme)
+
+  def _build(self, theme):
+    os.makedirs(self.directory, exist_ok=True)
+    known = self.manifest().get(theme, {})
+    previous = self._read_theme(theme)
+
+    files, entries, extracted = {}, {}, []
+    for name, stat in source_stats(theme).items():
+      entry = known.get(name, {})
+      # Files with the same size and mtime are not read again
+      same_stat = entry.get('size') == stat['size'] and entry.get('mtime_ns') == stat['mtime_ns']
+      sha = entry['sha256'] if same_stat and 'sha256' in entry else source_hash(theme, name)
+      if entry.get('sha256') == sha and name in previous:
+        files[name] = previous[name]
+      else:
+        with open(os.path.join(SAMPLES_DIR, theme, name), 'rb') as f:
+          files[name] = [sequence.SerializeToString() for sequence in extract(f.read(), theme)]
+        extracted.append(name)
+      entries[name] = {'sha256': sha, **stat, 'sequences': len(files[name])}
+
+    if extracted or set(previous) != set(files):
+      self._write(self._path(theme), lambda f: pickle.dump(files, f, protocol=pickle.HIGHEST_PROTOCOL), mode='wb')
+      self._update_manifest(theme, entries)
+      self.sequences.pop(theme, None)
+    elif entries != known:
+      # Touched files with the same content, their new mtime is recorded so they are not hashed again
+      self._update_manifest(theme, entries)
+    return extracted
+
+  def _update_manifest(self, theme, entries):
+    # The manifest is shared by the themes, read again and written under one lock so no update is lost
+    with self._locks_lock:
+      manifest = self.manifest()
+      manifest[theme] = entries
+      self._write(os.path.join(self.directory, MANIFEST), lambda f: json.dump(manifest, f, indent=2))
+
+  def load(self, theme):
+    """Sequences of a theme by source file, rebuilt first when the samples changed."""
+    with self.lock(theme):
+      if self.stale(theme):
+        self._build(theme)
+      if theme not in self.sequences:
+        import note_seq
+        self.sequences[theme] = {
+          name: [note_seq.NoteSequence.FromString(data) for data in serialized]
+          for name, serialized in self._read_theme(theme).items()
+        }
+      return self.sequences[theme]
+
+  def sequences_of(self, theme, sources):
+    """Extracted sequences of some source files of a theme, in the order of the sources."""
+    corpus = self.load(theme)
+    sequences = []
+    for name in sources:
+      sequences.extend(corpus[name])
+    return sequences
+
+
+if __name__ == '__main__':
+  corpus = Corpus()
+  for theme in sys.argv[1:] or THEMES:
+    extracted = corpus.build(theme)
+    counts = {name: entry['sequences'] for name, entry in corpus.manifest()[theme].items()}
+    print(f'{theme}: {len(extracted)} files extracted, {sum(counts.values())} sequences from {len(counts)} files')
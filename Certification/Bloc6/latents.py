@@ -0,0 +1,297 @@
+"""Latent vectors of the corpus sequences, for decode-only interpolation.
+
+Every 16-bar sequence of the corpus (corpus.py) is encoded once by the model
+of its theme and its latent mean z is stored in latents/<theme>.npy, opened
+memory-mapped. The json file next to it maps the rows to the sample files
+(with their sha256, so only the files added or changed are encoded again).
+The unit vectors used for cosine distances are stored too, normalized chunk
+by chunk at build time in latents/<theme>.unit.npy and memory-mapped as well,
+so choosing endpoints only reads the rows of the candidates.
+
+Interpolation endpoints are then chosen by distance between their z:
+  random       any two sequences, as before
+  smooth       the end is one of the nearest neighbors of the start
+  contrasting  the end is one of the farthest sequences from the start
+
+Many interpolations are decoded together by decode_interpolations, packed
+into full batches of the model.
+
+Usage: python latents.py [theme ...]   # encode the corpus, every theme by default
+"""
+
+import collections
+import json
+import os
+import random
+import sys
+
+import numpy as np
+
+from corpus import Corpus, MANIFEST, THEMES
+
+LATENTS_DIR = os.environ.get('MUSICVAE_LATENTS_DIR', 'latents')
+MODES = ['random', 'smooth', 'contrasting']
+# Rows normalized at a time when the unit vectors are written
+UNIT_CHUNK = 65536
+
+
+class EndpointError(ValueError):
+  """The samples do not have two encoded sequences to interpolate between."""
+
+
+def encode(model, sequences):
+  """
+  Latent means of sequences, a row of NaN for a sequence the model cannot encode.
+  When none can be encoded the rows have no column, their size is not known.
+  """
+  if not sequences:
+    return np.empty((0, 0), dtype=np.float32)
+  try:
+    _, mu, _ = model.encode(sequences)
+    return mu.astype(np.float32)
+  except Exception:
+    # One sequence failing fails the whole batch, encode them one by one
+    rows = []
+    for sequence in sequences:
+      try:
+        rows.append(model.encode([sequence])[1][0])
+      except Exception:
+        rows.append(None)
+    size = next((len(row) for row in rows if row is not None), None)
+    if size is None:
+      return np.empty((len(sequences), 0), dtype=np.float32)
+    return np.array([row if row is not None else np.full(size, np.nan) for row in rows], dtype=np.float32)
+
+
+def save_unit(path, z, chunk=UNIT_CHUNK):
+  """Write the unit vectors of z to a .npy file chunk by chunk, returns the rows that have none."""
+  unit = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.float32, shape=z.shape)
+  invalid = []
+  for start in range(0, len(z), chunk):
+    block = np.asarray(z[start:start + chunk], dtype=np.float32)
+    norms = np.linalg.norm(block, axis=1, keepdims=True)
+    # Sequences that could not be encoded (NaN) or null vectors
+    valid = np.isfinite(norms) & (norms > 0)
+    unit[start:start + chunk] = np.where(valid, block / np.where(valid, norms, 1), 0)
+    invalid.extend((start + np.flatnonzero(~valid[:, 0])).tolist())
+  unit.flush()
+  del unit
+  os.replace(path + '.tmp', path)
+  return invalid
+
+
+def file_signature(path):
+  try:
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+  except OSError:
+    return None
+
+
+def slerp(p0, p1, t):
+  """Spherical linear interpolation, as in TrainedModel.interpolate."""
+  omega = np.arccos(np.clip(np.dot(p0 / np.linalg.norm(p0), p1 / np.linalg.norm(p1)), -1, 1))
+  so = np.sin(omega)
+  if so == 0:
+    return (1.0 - t) * p0 + t * p1
+  return np.sin((1.0 - t) * omega) / so * p0 + np.sin(t * omega) / so * p1
+
+
+def decode_interpolations(model, requests, num_steps, length):
+  """
+  Interpolations of many (start, end, temperature) requests, a list of
+  num_steps NoteSequences per request. Endpoints are NoteSequences or latent
+  vectors, the sequences of all the requests are encoded in one call. The
+  temperature is a single value per session run: the latent vectors of the
+  requests with the same temperature are decoded together, in full batches
+  but for the last one.
+  """
+  sequences = [endpoint for start, end, _ in requests for endpoint in (start, end) if not isinstance(endpoint, np.ndarray)]
+  if sequences:
+    _, mu, _ = model.encode(sequences)
+    encoded = iter(mu)
+  endpoints = [[endpoint if isinstance(endpoint, np.ndarray) else next(encoded) for endpoint in (start, end)]
+               for start, end, _ in requests]
+
+  by_temperature = {}
+  for i, (_, _, temperature) in enumerate(requests):
+    by_temperature.setdefault(temperature, []).append(i)
+
+  results = [None] * len(requests)
+  for temperature, indices in by_temperature.items():
+    z = np.array([slerp(endpoints[i][0], endpoints[i][1], t) for i in indices for t in np.linspace(0, 1, num_steps)], dtype=np.float32)
+    decoded = model.decode(length=length, z=z, temperature=temperature)
+    for position, i in enumerate(indices):
+      results[i] = decoded[position * num_steps:(position + 1) * num_steps]
+  return results
+
+
+def batch_fill(requests, num_steps, batch_size):
+  """Share of the decoder batches used by decode_interpolations, the rest is padding."""
+  counts = collections.Counter(temperature for _, _, temperature in requests)
+  runs = sum(-(-count * num_steps // batch_size) for count in counts.values())
+  return len(requests) * num_steps / (runs * batch_size) if runs else 0.0
+
+
+class LatentIndex:
+  """Latent vectors of one theme with the rows of each sample file."""
+
+  def __init__(self, z, unit, files, invalid=()):
+    self.z = z
+    # Unit vectors for cosine distances, sequences that could not be encoded are left out
+    self.unit = unit
+    self.files = files
+    self.valid = np.ones(len(z), dtype=bool)
+    self.valid[list(invalid)] = False
+
+  def rows(self, samples=None):
+    """Rows of some sample files (all of them by default) that have a latent vector."""
+    if samples is None:
+      rows = np.arange(len(self.z))
+    else:
+      rows = np.concatenate([np.arange(self.files[name]['start'], self.files[name]['start'] + self.files[name]['count'])
+                             for name in samples if name in self.files] or [np.empty(0, dtype=int)])
+    return rows[self.valid[rows]]
+
+  def distances(self, row, rows):
+    # Cosine distance between one row and candidate rows, read from the memory map chunk by chunk
+    target = np.asarray(self.unit[row])
+    chunks = [self.unit[rows[start:start + UNIT_CHUNK]] @ target for start in range(0, len(rows), UNIT_CHUNK)]
+    return 1 - np.concatenate(chunks) if chunks else np.empty(0, dtype=np.float32)
+
+  def endpoints(self, samples=None, mode='random', neighbors=0.2):
+    """
+    Two rows to interpolate between. With smooth and contrasting the end is
+    drawn among the closest or farthest share (neighbors) of the candidates.
+    """
+    rows = self.rows(samples)
+    if len(rows) < 2:
+      raise EndpointError(f'{len(rows)} encoded sequence(s) in these samples, at least two are needed to interpolate')
+    start = int(random.choice(rows))
+    others = rows[rows != start]
+    if mode == 'random':
+      return start, int(random.choice(others))
+
+    order = np.argsort(self.distances(start, others))
+    if mode == 'contrasting':
+      order = order[::-1]
+    closest = others[order[:max(1, int(len(others) * neighbors))]]
+    return start, int(random.choice(closest))
+
+
+class LatentStore:
+
+  def __init__(self, directory=LATENTS_DIR, corpus=None):
+    self.directory = directory
+    self.corpus = corpus or Corpus()
+    self.indexes = {}
+
+    # Signatures of the corpus manifest and of the metadata last found up to date, by theme
+    self.checked = {}
+
+  def _paths(self, theme):
+    return os.path.join(self.directory, theme + '.npy'), os.path.join(self.directory, theme + '.json')
+
+  def _unit_path(self, theme):
+    return os.path.join(self.directory, theme + '.unit.npy')
+
+  def metadata(self, theme):
+    try:
+      with open(self._paths(theme)[1]) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def stale(self, theme):
+    # The corpus changed since the sequences were encoded, the files are compared again only when one was rewritten
+    signature = (file_signature(os.path.join(self.corpus.directory, MANIFEST)), file_signature(self._paths(theme)[1]))
+    if self.checked.get(theme) == signature:
+      return False
+    metadata = self.metadata(theme)
+    corpus_files = {name: entry['sha256'] for name, entry in self.corpus.manifest().get(theme, {}).items()}
+    stale = metadata is None or {name: entry['sha256'] for name, entry in metadata['files'].items()} != corpus_files
+    if not stale:
+      self.checked[theme] = signature
+    return stale
+
+  def _write_metadata(self, theme, metadata):
+    path = self._paths(theme)[1]
+    with open(path + '.tmp', 'w') as f:
+      json.dump(metadata, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+  def build(self, theme, model):
+    """Encode the sequences of the sample files added or changed since the last build."""
+    # Under the lock of the theme, its corpus cannot be rebuilt meanwhile
+    with self.corpus.lock(theme):
+      return self._build(theme, model)
+
+  def _build(self, theme, model):
+    os.makedirs(self.directory, exist_ok=True)
+    sequences = self.corpus.load(theme)
+    manifest = self.corpus.manifest()[theme]
+    previous = self.metadata(theme) or {'files': {}}
+    previous_z = np.load(self._paths(theme)[0], mmap_mode='r') if previous['files'] else None
+
+    blocks, files, start, encoded = [], {}, 0, []
+    for name in sorted(sequences):
+      known = previous['files'].get(name)
+      if known and known['sha256'] == manifest[name]['sha256']:
+        block = np.asarray(previous_z[known['start']:known['start'] + known['count']])
+      else:
+        block = encode(model, sequences[name])
+        encoded.append(name)
+      blocks.append(block)
+      files[name] = {'sha256': manifest[name]['sha256'], 'start': start, 'count': len(sequences[name])}
+      start += len(sequences[name])
+
+    z_size = max((block.shape[1] for block in blocks), default=0)
+    # Files without any encoded sequence keep their rows, as NaN
+    z = np.concatenate([block if block.shape[1] == z_size else np.full((len(block), z_size), np.nan, dtype=np.float32)
+                        for block in blocks] or [np.empty((0, 0), dtype=np.float32)])
+    npy = self._paths(theme)[0]
+    with open(npy + '.tmp', 'wb') as f:
+      np.save(f, z)
+    os.replace(npy + '.tmp', npy)
+    invalid = save_unit(self._unit_path(theme), z)
+    self._write_metadata(theme, {'model': THEMES[theme], 'z_size': z_size, 'files': files, 'invalid': invalid})
+    self.indexes.pop(theme, None)
+    return encoded
+
+  def index(self, theme, model_getter=None):
+    """
+    Latent index of a theme, memory-mapped. When the corpus changed the new
+    sequences are encoded first with the model returned by model_getter,
+    without it None is returned.
+    """
+    with self.corpus.lock(theme):
+      if self.corpus.stale(theme) or self.stale(theme):
+        if model_getter is None:
+          return None
+        self.corpus.load(theme)
+        self._build(theme, model_getter())
+      if theme not in self.indexes:
+        z = np.load(self._paths(theme)[0], mmap_mode='r')
+        metadata = self.metadata(theme)
+        if 'invalid' not in metadata or not os.path.exists(self._unit_path(theme)):
+          # Built before the unit vectors were stored, they are written once without encoding again
+          metadata['invalid'] = save_unit(self._unit_path(theme), z)
+          self._write_metadata(theme, metadata)
+        unit = np.load(self._unit_path(theme), mmap_mode='r')
+        self.indexes[theme] = LatentIndex(z, unit, metadata['files'], metadata['invalid'])
+      return self.indexes[theme]
+
+
+if __name__ == '__main__':
+  from model_manager import ModelManager
+
+  models = ModelManager()
+  store = LatentStore()
+  for theme in sys.argv[1:] or THEMES:
+    store.corpus.load(theme)
+    if store.stale(theme):
+      encoded = store.build(theme, models.get(THEMES[theme]))
+    else:
+      encoded = []
+    metadata = store.metadata(theme)
+    print(f"{theme}: {len(encoded)} files encoded, {sum(entry['count'] for entry in metadata['files'].values())} latent vectors of size {metadata['z_size']}")
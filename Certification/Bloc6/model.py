@@ -16,28 +16,20 @@ Original file is located at
 import random
 import glob
 
-BASE_DIR = "gs://download.magenta.tensorflow.org/models/music_vae/colab2"
-
 # Hack to allow python to pick up the newly-installed fluidsynth lib.
 # This is only needed for the hosted Colab environment.
 
 
-import magenta.music as mm
-from magenta.models.music_vae import configs
-from magenta.models.music_vae.trained_model import TrainedModel
-import note_seq as ns
-import midi2audio
-from midi2audio import FluidSynth
-import numpy as np
+# magenta, tensorflow and midi2audio are imported by the functions that use
+# them (and by model_manager.py when a model is built), not when the app starts.
+from model_manager import ModelManager
+from corpus import Corpus, THEMES, sample_files
+from latents import LatentStore, MODES, EndpointError, decode_interpolations
+from pool import GenerationPool
 import os
-import tensorflow.compat.v1 as tf
-import IPython as _IPython
 import uuid as _uuid
 import json
 
-
-tf.disable_v2_behavior()
-
 # Necessary until pyfluidsynth is updated (>1.2.5).
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -49,6 +41,8 @@ def interpolate(model, start_seq, end_seq, num_steps, max_length=32,
                 assert_same_length=True, temperature=0.5,
                 individual_duration=4.0):
     # Interpolates between a start and end sequence.
+    import magenta.music as mm
+
     note_sequences = model.interpolate(
       start_seq, end_seq,num_steps=num_steps, length=max_length,
       temperature=temperature,
@@ -58,31 +52,52 @@ def interpolate(model, start_seq, end_seq, num_steps, max_length=32,
     mm.plot_sequence(interp_seq)
     return interp_seq # note_sequences
 
+
+def interpolate_batch(model, requests, num_steps, max_length=32,
+                      individual_duration=4.0):
+    # Interpolations of many (start, end, temperature) requests, decoded together in full batches.
+    # Endpoints are sequences or stored latent vectors, one concatenated sequence per request.
+    import magenta.music as mm
+
+    return [mm.sequences_lib.concatenate_sequences(
+              note_sequences, [individual_duration] * len(note_sequences))
+            for note_sequences in decode_interpolations(model, requests, num_steps, max_length)]
+
 """## Load the pre-trained models.
 
 ### Load Melody model
 """
-def sequence_to_wav_file(sequence,theme):
-  """Convert a NoteSequence to a Wav file."""
-  filename = theme[:-1] + '.mid'
+def sequence_to_wav_file(sequence,theme,wav_file=None):
+  """Convert a NoteSequence to a Wav file (<theme>.wav by default)."""
+  import magenta.music as mm
+  from midi2audio import FluidSynth
+
+  wav_file = wav_file or theme[:-1] + '.wav'
+  filename = os.path.splitext(wav_file)[0] + '.mid'
   mm.note_sequence_to_midi_file(sequence, filename, None)
   # with tf.io.gfile.GFile(filename, 'wb') as f:
   #  f.write(filename)
   fs = FluidSynth('MuseScore_General.sf2')
-  fs.midi_to_audio(filename, theme[:-1] + '.wav')
-  return theme[:-1] + '.wav'
+  fs.midi_to_audio(filename, wav_file)
+  return wav_file
+
+# The pre-trained models are built on first use (or warmed in the background),
+# from the local checkpoint cache filled by: python model_manager.py prefetch
+models = ModelManager()
 
-# Load the pre-trained models.
-mel_16bar_models = {}
-hierdec_mel_16bar_config = configs.CONFIG_MAP['hierdec-mel_16bar']
-mel_16bar_models['hierdec_mel_16bar'] = TrainedModel(hierdec_mel_16bar_config, batch_size=4, checkpoint_dir_or_path=BASE_DIR + '/checkpoints/mel_16bar_hierdec.ckpt')
+# 16-bar melodies and trios extracted once from the samples, see corpus.py
+corpus = Corpus()
+# Their latent vectors, encoded once, see latents.py
+latent_store = LatentStore(corpus=corpus)
 
-"""### Load Trio Model"""
+# MUSICVAE_WARM=all builds both models in the background as soon as the app starts
+if os.environ.get('MUSICVAE_WARM') == 'all':
+  models.warm()
 
-# Load the pre-trained models.
-trio_models = {}
-hierdec_trio_16bar_config = configs.CONFIG_MAP['hierdec-trio_16bar']
-trio_models['hierdec_trio_16bar'] = TrainedModel(hierdec_trio_16bar_config, batch_size=4, checkpoint_dir_or_path=BASE_DIR + '/checkpoints/trio_16bar_hierdec.ckpt')
+
+def model_name(theme):
+  # Sad themes are melodies, dance themes are trios
+  return THEMES[theme[:-1]]
 
 """## Generate
 
@@ -90,78 +105,92 @@ trio_models['hierdec_trio_16bar'] = TrainedModel(hierdec_trio_16bar_config, batc
 """
 
 def create_input(choice): 
-  # Create a list of 3 usable MIDI paths
+  # Pick 3 MIDI samples of the theme (the same one can be picked twice, it is used once)
 
-  paths = []
-  
   if choice == 'Dance':
     theme = 'dance/'
   else :
     theme = 'sad/'
-  for path in range(3):
-    dance_random = random.choice(os.listdir("midi_samples/" + theme))
-    while dance_random[0] == '.':
-      dance_random = random.choice(os.listdir("midi_samples/" + theme)) 
-    path = ('midi_samples/'+ theme + dance_random)
-    paths.append(path)
+  samples = sample_files(theme[:-1])
   
   # Use example MIDI files for interpolation endpoints.
-  return [
-          tf.io.gfile.GFile(fn, 'rb').read()
-          for fn in sorted(tf.io.gfile.glob(paths))], theme
+  return sorted(set(random.choice(samples) for _ in range(3))), theme
 
 """### Exctract from MIDI"""
 
-def gen_interpolation(input_midi_data,theme):
-  input_seqs = [mm.midi_to_sequence_proto(m) for m in input_midi_data]
-  if theme == 'sad/':
-    # Extract melodies from MIDI files. This will extract all unique 16-bar melodies using a sliding window with a stride of 1 bar.
-    
-    extracted_16_mels = []
-    for ns in input_seqs:
-      extracted_16_mels.extend(
-          hierdec_mel_16bar_config.data_converter.from_tensors(
-              hierdec_mel_16bar_config.data_converter.to_tensors(ns)[1]))
-    return extracted_16_mels
+def gen_interpolation(input_samples,theme):
+  # All unique 16-bar melodies (sad) or trios (dance) of the samples, using a sliding window with a stride of 1 bar.
+  # They were extracted once by corpus.py, new or changed samples are extracted on the first call.
+  return corpus.sequences_of(theme[:-1], input_samples)
 
-  else :
-    # Extract trios from MIDI files. This will extract all unique 16-bar trios using a sliding window with a stride of 1 bar.
+"""### Generate final wav"""
 
-    extracted_trios = []
-    for ns in input_seqs:
-      extracted_trios.extend(
-          hierdec_trio_16bar_config.data_converter.from_tensors(
-              hierdec_trio_16bar_config.data_converter.to_tensors(ns)[1]))
-    return extracted_trios
+def random_temperature():
+  return random.randint(1, 16)/10.0
 
-"""### Generate final wav"""
+def gen_request(theme, samples, mode, temperature):
+  # Endpoints chosen among the stored latent vectors of the samples (random, smooth or contrasting)
+  index = latent_store.index(theme[:-1], lambda: models.get(model_name(theme)))
+  start, end = index.endpoints(samples, mode)
+  return index.z[start], index.z[end], temperature
 
-def gen_final(extracted_16, theme):
+def gen_from_latents(theme, samples, mode='random'):
+  # Decode only, from the stored latent vectors of the samples. Raises EndpointError when they have
+  # fewer than two encoded sequences
+  interp_model = model_name(theme)
+  request = gen_request(theme, samples, mode, random_temperature())
+  return interpolate_batch(models.get(interp_model), [request], num_steps=3, max_length=256, individual_duration=32)[0], interp_model
+
+def gen_final(extracted_16, theme, samples=None, mode='random'):
   # Compute the reconstructions and mean
-  interp_model = ''
-  final_model = mel_16bar_models
-  if theme == 'sad/':
-    interp_model = "hierdec_mel_16bar"
-  else:
-    interp_model = "hierdec_trio_16bar"
-    final_model = trio_models
-
-
-  start = random.randint(0,len(extracted_16))
-  end = start
-  while start == end :
-    end = random.randint(0,len(extracted_16))
-  if end < start :
-    a = end
-    end =start
-    start = a
+  if samples is not None:
+    return gen_from_latents(theme, samples, mode)
+
+  interp_model = model_name(theme)
+  temperature = random_temperature()
+
+  # Two different sequences, the start one first
+  start, end = sorted(random.sample(range(len(extracted_16)), 2))
   
   start = extracted_16[start]
   end = extracted_16[end]
-
-  temperature = random.randint(1, 16)/10.0
   
-  return interpolate(final_model[interp_model], start, end, num_steps=3, max_length=256, individual_duration=32, temperature=temperature), interp_model
+  return interpolate(models.get(interp_model), start, end, num_steps=3, max_length=256, individual_duration=32, temperature=temperature), interp_model
+
+"""### Pre-generated tracks"""
+
+def generate_tracks(key, wav_files):
+  # Tracks of a (choice, mode) pool generated together: each one has its own samples and endpoints,
+  # they share a temperature so that their interpolations fill the same decoder batches
+  choice, mode = key
+  temperature = random_temperature()
+  requests = []
+  for _ in wav_files:
+    input_samples, theme = create_input(choice)
+    requests.append(gen_request(theme, input_samples, mode, temperature))
+  sequences = interpolate_batch(models.get(model_name(theme)), requests, num_steps=3, max_length=256, individual_duration=32)
+  for g_16bar_mean, wav_file in zip(sequences, wav_files):
+    sequence_to_wav_file(g_16bar_mean, theme, wav_file)
+    os.remove(os.path.splitext(wav_file)[0] + '.mid')
+
+# Tracks of each theme and transition kept ready in the background, see pool.py
+pool = GenerationPool(generate_tracks)
+
+# MUSICVAE_WARM=all also fills the pools of every theme and transition from the start
+if os.environ.get('MUSICVAE_WARM') == 'all':
+  for choice in ['Sad', 'Dance']:
+    for mode in MODES:
+      pool.start((choice, mode))
+
+def pop_track(choice, mode):
+  # WAV data of a ready track, None when the pool has none and the track has to be generated now
+  track = pool.get((choice, mode))
+  if track is None:
+    return None
+  with open(track.path, 'rb') as f:
+    data = f.read()
+  os.remove(track.path)
+  return data
 
 '''
 def main():
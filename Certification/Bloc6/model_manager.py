@@ -0,0 +1,191 @@
+"""Lazy loading of the MusicVAE models from a local checkpoint cache.
+
+A model graph is built the first time it is needed (get), or ahead of time
+in a background thread (warm), and never at import. Checkpoints are read from
+a local cache directory filled by the prefetch command, every file is checked
+against the sha256 recorded in the cache manifest before the first load.
+Without a cached copy the model is read from the Magenta bucket as before.
+
+Usage:
+  python model_manager.py prefetch   # download the checkpoints into the cache
+  python model_manager.py verify     # check the cached files against the manifest
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+BASE_DIR = "gs://download.magenta.tensorflow.org/models/music_vae/colab2"
+CACHE_DIR = os.environ.get('MUSICVAE_CACHE_DIR', 'checkpoints')
+MANIFEST = 'manifest.json'
+# Latent vectors encoded or decoded per session run, larger batches decode more tracks at once
+BATCH_SIZE = int(os.environ.get('MUSICVAE_BATCH_SIZE', 4))
+
+# Model name: MusicVAE config and checkpoint prefix
+MODELS = {
+  'hierdec_mel_16bar': ('hierdec-mel_16bar', 'mel_16bar_hierdec.ckpt'),
+  'hierdec_trio_16bar': ('hierdec-trio_16bar', 'trio_16bar_hierdec.ckpt'),
+}
+
+
+class CheckpointError(Exception):
+  pass
+
+
+def file_hash(path):
+  sha = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      sha.update(block)
+  return sha.hexdigest()
+
+
+def config(name):
+  # Configs are cheap, only the data converter is needed to extract sequences
+  from magenta.models.music_vae import configs
+  return configs.CONFIG_MAP[MODELS[name][0]]
+
+
+class CheckpointCache:
+  """Local copy of the checkpoint files with their sha256 in a manifest."""
+
+  def __init__(self, directory=CACHE_DIR):
+    self.directory = directory
+
+  def manifest(self):
+    try:
+      with open(os.path.join(self.directory, MANIFEST)) as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return {}
+
+  def _save_manifest(self, manifest):
+    path = os.path.join(self.directory, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+      json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+  def prefetch(self, names=None):
+    """Download the checkpoint files missing or corrupted in the cache."""
+    import tensorflow.compat.v1 as tf
+
+    os.makedirs(self.directory, exist_ok=True)
+    manifest = self.manifest()
+    for name in names or MODELS:
+      checkpoint = MODELS[name][1]
+      files = {}
+      for remote in tf.io.gfile.glob(f'{BASE_DIR}/checkpoints/{checkpoint}*'):
+        filename = os.path.basename(remote)
+        local = os.path.join(self.directory, filename)
+        known = manifest.get(name, {}).get('files', {}).get(filename)
+        if known and os.path.exists(local) and file_hash(local) == known:
+          files[filename] = known
+          continue
+        print(f'Downloading {remote}')
+        tf.io.gfile.copy(remote, local + '.tmp', overwrite=True)
+        os.replace(local + '.tmp', local)
+        files[filename] = file_hash(local)
+      if not files:
+        raise CheckpointError(f'No checkpoint file found for {checkpoint} in {BASE_DIR}')
+      manifest[name] = {'checkpoint': checkpoint, 'files': files}
+      self._save_manifest(manifest)
+    return manifest
+
+  def verify(self, name):
+    """Local checkpoint path of a model, None when it is not cached, raises when a file is corrupted."""
+    entry = self.manifest().get(name)
+    if entry is None:
+      return None
+    for filename, expected in entry['files'].items():
+      path = os.path.join(self.directory, filename)
+      if not os.path.exists(path) or file_hash(path) != expected:
+        raise CheckpointError(f'{path} does not match the manifest, run: python model_manager.py prefetch')
+    return os.path.join(self.directory, entry['checkpoint'])
+
+
+class ModelManager:
+  """Build each MusicVAE model once, on first use or in a background thread."""
+
+  def __init__(self, cache=None, batch_size=BATCH_SIZE):
+    self.cache = cache or CheckpointCache()
+    self.batch_size = batch_size
+    self.models = {}
+    self.load_times = {}
+    self.sources = {}
+    self.errors = {}
+    self._locks = {name: threading.Lock() for name in MODELS}
+
+  def get(self, name):
+    """The TrainedModel of a model name, built on the first call (blocking)."""
+    model = self.models.get(name)
+    if model is not None:
+      return model
+    with self._locks[name]:
+      # Another thread may have built it while this one was waiting
+      if name not in self.models:
+        self._load(name)
+    return self.models[name]
+
+  def _load(self, name):
+    import tensorflow.compat.v1 as tf
+    from magenta.models.music_vae.trained_model import TrainedModel
+
+    # The checkpoints are TF1 graphs, set before the first model is built (no-op afterwards)
+    tf.disable_v2_behavior()
+    start_time = time.time()
+    try:
+      checkpoint = self.cache.verify(name)
+      source = 'cache' if checkpoint else 'remote'
+      if checkpoint is None:
+        checkpoint = f'{BASE_DIR}/checkpoints/{MODELS[name][1]}'
+      self.models[name] = TrainedModel(config(name), batch_size=self.batch_size, checkpoint_dir_or_path=checkpoint)
+    except Exception as e:
+      self.errors[name] = str(e)
+      raise
+    self.errors.pop(name, None)
+    self.sources[name] = source
+    self.load_times[name] = time.time() - start_time
+
+  def warm(self, names=None):
+    """Build models in a background thread, get() then waits only for what is left."""
+    # Models already built or being built are skipped, warm() can be called on every rerun
+    names = [name for name in (names or MODELS) if name not in self.models and not self._locks[name].locked()]
+
+    def load_all():
+      for name in names:
+        try:
+          self.get(name)
+        except Exception:
+          # Kept in errors and raised again by the next get()
+          pass
+
+    if names:
+      threading.Thread(target=load_all, daemon=True).start()
+
+  def status(self):
+    return {
+      name: {
+        'loaded': name in self.models,
+        'loading': self._locks[name].locked(),
+        'load_time': self.load_times.get(name),
+        'source': self.sources.get(name),
+        'error': self.errors.get(name),
+      }
+      for name in MODELS
+    }
+
+
+if __name__ == '__main__':
+  command = sys.argv[1] if len(sys.argv) > 1 else 'prefetch'
+  cache = CheckpointCache()
+  if command == 'prefetch':
+    manifest = cache.prefetch()
+    print(f'{len(manifest)} checkpoints cached in {cache.directory}')
+  elif command == 'verify':
+    for name in MODELS:
+      print(name, cache.verify(name) or 'not cached')
+  else:
+    sys.exit('Usage: python model_manager.py [prefetch|verify]')
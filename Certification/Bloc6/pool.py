@@ -0,0 +1,189 @@
+"""Pool of tracks generated ahead of time, so Generate can play one at once.
+
+Each pool (a theme and a transition mode) keeps up to `size` rendered WAV
+files ready. A fixed number of worker threads, shared by all the pools, refill
+the emptiest pool first, up to `batch` tracks of a pool at once so that
+their interpolations are decoded together. Tracks older than `max_age` seconds are dropped, so
+the pool keeps being renewed when it is not used. The hits and misses are
+counted to size the pools for peak traffic: a miss means the user waited for
+a synchronous generation.
+
+Configured by environment variables:
+  MUSICVAE_POOL_SIZE      ready tracks per pool, 0 disables the pool (default 2)
+  MUSICVAE_POOL_WORKERS   worker threads generating at the same time (default 1)
+  MUSICVAE_POOL_BATCH     tracks of a pool generated together by a worker (default 4)
+  MUSICVAE_POOL_MAX_AGE   seconds before a ready track is dropped, 0 to keep them (default 3600)
+  MUSICVAE_POOL_DIR       directory of the ready WAV files (default pool)
+"""
+
+import collections
+import os
+import threading
+import time
+import uuid
+
+POOL_SIZE = int(os.environ.get('MUSICVAE_POOL_SIZE', 2))
+POOL_WORKERS = int(os.environ.get('MUSICVAE_POOL_WORKERS', 1))
+POOL_BATCH = int(os.environ.get('MUSICVAE_POOL_BATCH', 4))
+POOL_MAX_AGE = float(os.environ.get('MUSICVAE_POOL_MAX_AGE', 3600))
+POOL_DIR = os.environ.get('MUSICVAE_POOL_DIR', 'pool')
+# Seconds before a pool whose generation failed is tried again
+RETRY_DELAY = 30
+
+Track = collections.namedtuple('Track', ['key', 'path', 'created', 'generation_time'])
+
+
+def remove(path):
+  try:
+    os.remove(path)
+  except OSError:
+    pass
+
+
+class GenerationPool:
+  """
+  Bounded queues of ready tracks by key, refilled in the background.
+
+  generate(key, paths) renders tracks of a key into the WAV files paths.
+  """
+
+  def __init__(self, generate, size=POOL_SIZE, workers=POOL_WORKERS, batch=POOL_BATCH, max_age=POOL_MAX_AGE, directory=POOL_DIR):
+    self.generate = generate
+    self.size = size
+    self.workers = workers
+    self.batch = batch
+    self.max_age = max_age
+    self.directory = directory
+    # Ready tracks by key, oldest first, and tracks being generated
+    self.ready = {}
+    self.pending = {}
+    self.counts = {}
+    self.generation_times = {}
+    self.errors = {}
+    self.retry_at = {}
+    self._condition = threading.Condition()
+    self._threads = []
+
+  def _count(self, key, name, amount=1):
+    counts = self.counts.setdefault(key, collections.Counter())
+    counts[name] += amount
+
+  def start(self, key):
+    """Keep `size` tracks of a key ready from now on, can be called on every rerun."""
+    if self.size <= 0:
+      return
+    with self._condition:
+      if key in self.ready:
+        return
+      self.ready[key] = collections.deque()
+      self.pending[key] = 0
+      # Workers are started with the first pool
+      while len(self._threads) < self.workers:
+        thread = threading.Thread(target=self._work, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+      self._condition.notify_all()
+
+  def get(self, key):
+    """The oldest fresh track of a key, None when none is ready (a miss). The caller owns the file."""
+    with self._condition:
+      self._expire()
+      tracks = self.ready.get(key)
+      if not tracks:
+        self._count(key, 'misses')
+        return None
+      track = tracks.popleft()
+      self._count(key, 'hits')
+      # A slot is free, wake a worker to refill it
+      self._condition.notify_all()
+      return track
+
+  def _expire(self):
+    # Drop the tracks older than max_age, called under the lock
+    if self.max_age <= 0:
+      return
+    limit = time.time() - self.max_age
+    for key, tracks in self.ready.items():
+      while tracks and tracks[0].created < limit:
+        remove(tracks.popleft().path)
+        self._count(key, 'expired')
+        self._condition.notify_all()
+
+  def _next_key(self):
+    # The pool with the fewest tracks ready or on the way and how many it misses, None when they are all full or failing
+    now = time.time()
+    missing = {key: self.size - len(tracks) - self.pending[key] for key, tracks in self.ready.items()
+               if len(tracks) + self.pending[key] < self.size and self.retry_at.get(key, 0) <= now}
+    if not missing:
+      return None, 0
+    key = max(missing, key=missing.get)
+    return key, missing[key]
+
+  def _timeout(self):
+    # Wake up to expire old tracks and retry failed pools even when nothing is taken. A retry time
+    # already passed is left out: that pool is full or being refilled and a worker is woken when it changes.
+    now = time.time()
+    deadlines = [retry_at - now for retry_at in self.retry_at.values() if retry_at > now]
+    if self.max_age > 0:
+      deadlines.append(self.max_age)
+    return min(deadlines) if deadlines else None
+
+  def _work(self):
+    os.makedirs(self.directory, exist_ok=True)
+    while True:
+      with self._condition:
+        self._expire()
+        key, missing = self._next_key()
+        while key is None:
+          self._condition.wait(timeout=self._timeout())
+          self._expire()
+          key, missing = self._next_key()
+        count = min(missing, max(1, self.batch))
+        self.pending[key] += count
+
+      paths = [os.path.join(self.directory, f'{uuid.uuid4().hex}.wav') for _ in range(count)]
+      start_time = time.time()
+      try:
+        self.generate(key, paths)
+      except Exception as e:
+        for path in paths:
+          remove(path)
+        with self._condition:
+          self.pending[key] -= count
+          self._count(key, 'errors')
+          self.errors[key] = str(e)
+          # The other pools are refilled meanwhile
+          self.retry_at[key] = time.time() + RETRY_DELAY
+        continue
+
+      # Time of the whole batch, shared by its tracks
+      generation_time = time.time() - start_time
+      with self._condition:
+        self.pending[key] -= count
+        created = time.time()
+        self.ready[key].extend(Track(key, path, created, generation_time / count) for path in paths)
+        self._count(key, 'generated', count)
+        self.generation_times[key] = self.generation_times.get(key, 0) + generation_time
+        self.errors.pop(key, None)
+        self.retry_at.pop(key, None)
+
+  def stats(self):
+    with self._condition:
+      self._expire()
+      stats = {}
+      for key in set(self.ready) | set(self.counts):
+        counts = self.counts.get(key, collections.Counter())
+        requests = counts['hits'] + counts['misses']
+        stats[key] = {
+          'ready': len(self.ready.get(key, ())),
+          'generating': self.pending.get(key, 0),
+          'hits': counts['hits'],
+          'misses': counts['misses'],
+          'hit_rate': counts['hits'] / requests if requests else None,
+          'generated': counts['generated'],
+          'expired': counts['expired'],
+          'errors': counts['errors'],
+          'mean_generation_time': self.generation_times[key] / counts['generated'] if counts['generated'] else None,
+          'error': self.errors.get(key),
+        }
+      return stats